@@ -1,14 +1,77 @@
 #!/usr/bin/python3
 import time
-from PIL import Image
-import cv2
-import numpy as np
+import importlib.util
 import os
+import re
+import io
+import json
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import functools
+import collections
+import ctypes
+import ctypes.util
+import select
+import http.server
+import urllib.parse
+import struct
+import contextlib
+import cProfile
+import tracemalloc
+import multiprocessing
+import concurrent.futures
 import sys
 import math
 import logging
 from pathlib import Path
-from CoreSharedLibs import csl
+
+
+def lazy_import(name):
+    """
+    Imports a module on first use rather than right away. cv2, numpy and PIL take most of the startup time, and a
+    run that finds nothing to cut and its lineup already rendered never needs them.
+    :param name: Module name, e.g. "PIL.Image".
+    :return: The module, loaded as soon as anything on it is touched.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition(".")
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+lazy_import_lock = threading.Lock()
+
+
+def load_now(*modules):
+    """
+    Finishes loading lazy modules. Python 3.11's LazyLoader isn't safe to set off from two threads at once (one of
+    them gets a half loaded module), so anything that runs on thread pools loads what it needs through here first.
+    :param modules: Modules from lazy_import.
+    :return: None
+    """
+    with lazy_import_lock:
+        for module in modules:
+            getattr(module, "__spec__")  # Any attribute will do.
+
+
+Image = lazy_import("PIL.Image")
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+# csl imports numpy itself, which would load it straight away, so csl waits too.
+csl = lazy_import("CoreSharedLibs.csl")
 
 # You can get this (^) by running
 # pip install BTCoreSharedLibs
@@ -17,30 +80,601 @@ from CoreSharedLibs import csl
 # "Global" vars
 class GlobalVars:
     def __init__(self):
-        self.base_dir = Path(__file__).parent
-        self.original_images_dir = self.base_dir / "Originals"
-        self.char_dir = self.base_dir / "Character_Lists"
-        self.char_dir_nude = self.char_dir / "Nude"
-        self.char_dir_clothed = self.char_dir / "Clothed"
-        self.char_dir_entry = self.char_dir / "Entry_Values"
-        self.output_dir = self.base_dir / "Output"
+        self.set_base_dir(Path(__file__).parent)
+        self.catalog = None  # SpriteCatalog, loaded during folder_setup()
+        self.sprite_cache = None  # SpriteCache, made during folder_setup()
+        self.cache_mb = 512  # --cache-mb N. How much decoded sprite data to keep around between lineups.
+        self.render_cache = None  # RenderCache, made during folder_setup()
+        self.render_cache_mb = 1024  # --render-cache-mb N. Finished lineups kept for reuse. 0 turns it off.
+        self.render_cache_days = 30  # --render-cache-days N. Lineups not asked for in this long are dropped.
+        self.no_preprocess = False  # --no-preprocess. Don't check Originals for new sheets, go straight to the lineup.
+        self.png_level = 1  # --png-level N. zlib level (0-9) sprites are saved with. Low is quick, 9 is smallest.
+        self.recompress_idle = False  # --recompress-idle. --watch recompresses sprites at level 9 while idle.
+        self.recompress_idle_after = 30.0  # Seconds --watch has to be idle before recompressing.
+        self.sprite_store = None  # SpriteStore, opened during folder_setup() with --sprite-store
+        self.use_sprite_store = False  # --sprite-store. Sprites are read raw from Character_Lists/sprites.raw.
+        self.row_cache = None  # RowCache, made during folder_setup() with --incremental
+        self.incremental = False  # --incremental. Composited rows are kept, and reused by later lineups.
+        self.row_cache_mb = 4096  # --row-cache-mb N. Rows are kept full size, so this fills up quicker.
+        self.decode_pool = None  # Thread pool sprites are decoded on, made during folder_setup()
+        self.decode_workers = 0  # --decode-workers N. Threads decoding sprites for lineups. 0 is one per CPU.
+        self.decode_ahead = 2  # --decode-ahead N. Rows decoded ahead of the compositor, per lineup being built.
+        self.jobs_file = ""  # --jobs-file jobs.json. Runs the jobs in it, no prompts. See run_jobs_file.
+        self.jobs = 0  # --jobs N. Sheets are cut in N processes, rather than threads.
+        self.bg_tolerance = 0  # How far off bg_colours (per channel) a pixel can be, and still count as background.
+        self.split_pages = False  # --split. Lineups too big for one WebP become several pages, instead of scaling.
+        self.formats = "webp"  # --formats webp,png,avif,jxl. Every lineup is saved in each of these.
+        self.preview = 0  # --preview SCALE. 2, 4 or 8: lineups are built from sprites that much smaller. 0 is off.
+        self.trim = False  # --trim. Sprites are cropped to what's on them, and packed together. See lineup_layout.
+        self.trim_padding = 16  # --trim-padding N. Pixels of background kept around each trimmed sprite.
+        self.memory_budget = 0  # --memory-budget MB. What a lineup may take to build. 0 is half the machine's RAM.
+        self.bg_sample_step = 16  # Blank check looks at every Nth row/column first, before checking every pixel.
         self.bg_colours = [
             [239, 239, 239, 255],
             [230, 230, 230, 255],
             [229, 229, 229, 255],
         ]
         # White-ish grey, darker grey, and slightly more different darker grey.
+        self.watch = False  # --watch. Keeps running, cutting sheets as they're dropped into Originals.
+        self.watch_debounce = 2.0  # Seconds a sheet has to sit untouched before it's cut.
+        self.watch_interval = 1.0  # Seconds between folder scans, when polling.
+        self.watch_poll = False  # --watch-poll. Poll even where inotify works. For network shares and the like.
+        self.sheet_pool = None  # Process pool kept alive between batches in --watch mode.
+        self.serve_port = 0  # --serve PORT. Runs the lineup server, see serve_lineups.
+        self.serve_host = "127.0.0.1"
+        self.serve_workers = 4  # Lineups rendered at once. Further requests wait their turn.
+        self.profile = ""  # --profile trace.json. Records a trace of the run to that file.
+        self.profile_format = "chrome"  # --profile-format chrome/json
+        self.profile_cprofile = False  # --profile-cprofile. Also runs cProfile, saved next to the trace as .prof.
+        self.profile_tracemalloc = False  # --profile-tracemalloc. Also tracks python allocations.
+        self.bench_sheets = 20  # bench --bench-sheets N
+        self.bench_costumes = 3  # bench --bench-costumes N. Clothed panels per synthetic sheet.
+        self.bench_blanks = 1  # bench --bench-blanks N. Blank panels per synthetic sheet.
+        self.bench_out = ""  # bench --bench-out results.json
+
+    def set_base_dir(self, base_dir):
+        """
+        Points every folder at a new base. Used by bench to work in a temp dir.
+        :param base_dir: Path.
+        :return: None
+        """
+        self.base_dir = base_dir
+        self.original_images_dir = self.base_dir / "Originals"
+        self.char_dir = self.base_dir / "Character_Lists"
+        self.char_dir_nude = self.char_dir / "Nude"
+        self.char_dir_clothed = self.char_dir / "Clothed"
+        self.char_dir_entry = self.char_dir / "Entry_Values"
+        self.output_dir = self.base_dir / "Output"
+        self.catalog_file = self.char_dir / "catalog.json"
+        self.render_cache_dir = self.char_dir / "Render_Cache"
+        self.row_cache_dir = self.char_dir / "Row_Cache"
+        self.sprite_store_file = self.char_dir / "sprites.raw"
+        self.sprite_store_index = self.char_dir / "sprites_index.json"
+        self.preview_dir = self.char_dir / "Previews"
 
 
 script_globals = GlobalVars()
 
+# Long options. "--name": (script_globals attribute, type). Taken out of the args before -n/-c/-an/-ac are read.
+cli_options = {
+    "--jobs": ("jobs", int),
+    "--jobs-file": ("jobs_file", str),
+    "--bg-tolerance": ("bg_tolerance", int),
+    "--split": ("split_pages", bool),
+    "--formats": ("formats", str),
+    "--cache-mb": ("cache_mb", int),
+    "--render-cache-mb": ("render_cache_mb", int),
+    "--render-cache-days": ("render_cache_days", float),
+    "--no-preprocess": ("no_preprocess", bool),
+    "--png-level": ("png_level", int),
+    "--recompress-idle": ("recompress_idle", bool),
+    "--sprite-store": ("use_sprite_store", bool),
+    "--incremental": ("incremental", bool),
+    "--row-cache-mb": ("row_cache_mb", int),
+    "--watch": ("watch", bool),
+    "--watch-debounce": ("watch_debounce", float),
+    "--watch-interval": ("watch_interval", float),
+    "--watch-poll": ("watch_poll", bool),
+    "--serve": ("serve_port", int),
+    "--serve-host": ("serve_host", str),
+    "--serve-workers": ("serve_workers", int),
+    "--decode-workers": ("decode_workers", int),
+    "--decode-ahead": ("decode_ahead", int),
+    "--memory-budget": ("memory_budget", int),
+    "--preview": ("preview", int),
+    "--trim": ("trim", bool),
+    "--trim-padding": ("trim_padding", int),
+    "--profile": ("profile", str),
+    "--profile-format": ("profile_format", str),
+    "--profile-cprofile": ("profile_cprofile", bool),
+    "--profile-tracemalloc": ("profile_tracemalloc", bool),
+    "--bench-sheets": ("bench_sheets", int),
+    "--bench-costumes": ("bench_costumes", int),
+    "--bench-blanks": ("bench_blanks", int),
+    "--bench-out": ("bench_out", str),
+}
+
 # Configure logging
 logging.basicConfig(
     format="%(asctime)s - %(message)s", datefmt="%d-%b-%y %H:%M:%S", level=logging.INFO
 )
 
 
+class Tracer:
+    """
+    Instrumentation for --profile. Timing spans around each step, and counters for bytes read/written and images
+    decoded. Does nothing unless started, so it stays wired in everywhere at next to no cost.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.profiler = None
+
+    @contextlib.contextmanager
+    def span(self, name, **args):
+        """
+        Times the with block as one span. Extra keyword args are kept with the span, e.g. which sheet it was.
+        """
+        if not self.enabled:
+            yield
+            return
+        start_wall = time.time_ns() // 1000  # Wall clock, so spans from worker processes line up.
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            event = {
+                "name": name,
+                "ph": "X",
+                "ts": start_wall,
+                "dur": (time.perf_counter_ns() - start) // 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def count(self, counter, amount=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[counter] += amount
+
+    def drain(self):
+        """
+        Hands over (and forgets) everything recorded so far. Worker processes send this back with their results.
+        :return: Dict, for merge().
+        """
+        with self.lock:
+            trace = {"events": self.events, "counters": dict(self.counters)}
+            self.events = []
+            self.counters = collections.Counter()
+        return trace
+
+    def merge(self, trace):
+        with self.lock:
+            self.events += trace["events"]
+            self.counters.update(trace["counters"])
+
+    def start(self):
+        self.enabled = True
+        if script_globals.profile_cprofile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        if script_globals.profile_tracemalloc:
+            tracemalloc.start()
+
+    def finish(self, trace_file):
+        """
+        Writes the trace out, either as Chrome trace format (open it in chrome://tracing or ui.perfetto.dev) or
+        plain json, depending on --profile-format. cProfile stats go next to it, as <trace>.prof.
+        :param trace_file: Path to write to.
+        :return: None
+        """
+        trace_file = Path(trace_file)
+        summary = {}
+        for event in self.events:
+            stage = summary.setdefault(event["name"], {"count": 0, "seconds": 0})
+            stage["count"] += 1
+            stage["seconds"] += event["dur"] / 1e6
+        for stage in summary.values():
+            stage["seconds"] = round(stage["seconds"], 3)
+        extra = {"summary": summary, "counters": dict(self.counters)}
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(trace_file.with_suffix(".prof"))
+            print(f"File name {trace_file.with_suffix('.prof')} saved!.")
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            extra["tracemalloc"] = {
+                "current_mb": round(current / (1024 * 1024), 1),
+                "peak_mb": round(peak / (1024 * 1024), 1),
+                "top": [str(stat) for stat in tracemalloc.take_snapshot().statistics("lineno")[:10]],
+            }
+            tracemalloc.stop()
+
+        if script_globals.profile_format == "chrome":
+            last_ts = max((event["ts"] + event["dur"] for event in self.events), default=0)
+            trace = {
+                "traceEvents": self.events
+                + [
+                    {"name": name, "ph": "C", "ts": last_ts, "pid": os.getpid(), "args": {name: value}}
+                    for name, value in self.counters.items()
+                ],
+                "displayTimeUnit": "ms",
+                "otherData": extra,
+            }
+        else:
+            trace = {"spans": self.events, **extra}
+        with open(trace_file, "w", encoding="utf-8") as trace_json:
+            json.dump(trace, trace_json, indent=1)
+        print(f"File name {trace_file} saved!.")
+
+
+tracer = Tracer()
+
+
+class SpriteCatalog:
+    """
+    On-disk index of every pre-cut character, kept as a JSON manifest under Character_Lists.
+    Maps character number -> nude sprites, clothed variants, entry value png and the source sheets used.
+    Only character folders whose mtime changed since the last sync get re-listed.
+    """
+
+    version = 1
+
+    def __init__(self, catalog_file):
+        self.catalog_file = Path(catalog_file)
+        self.chars = {}
+        self.sources = {}
+        self.recompress = []  # Sprites saved at a quick png_level, for recompress_sprites to go over.
+        self.boxes = {}  # Content box of each sprite, by path relative to Character_Lists. See sprite_box.
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        """
+        Reads the manifest from disk. A missing, corrupt or outdated manifest is rebuilt on the next refresh.
+        :return: None
+        """
+        try:
+            with open(self.catalog_file, "r", encoding="utf-8") as catalog_json:
+                data = json.load(catalog_json)
+        except (OSError, ValueError):
+            data = {}
+        if data.get("version") == self.version:
+            self.chars = data.get("chars", {})
+            self.sources = data.get("sources", {})
+            self.recompress = data.get("recompress", [])
+            self.boxes = data.get("boxes", {})
+        else:
+            self.dirty = True
+
+    def save(self):
+        """
+        Writes the manifest back to disk, if anything changed. Written to a temp file first so a crash can't
+        leave half a catalog behind.
+        :return: None
+        """
+        if not self.dirty:
+            return
+        temp_file = self.catalog_file.with_suffix(".tmp")
+        with open(temp_file, "w", encoding="utf-8") as catalog_json:
+            json.dump(
+                {
+                    "version": self.version,
+                    "chars": self.chars,
+                    "sources": self.sources,
+                    "recompress": self.recompress,
+                    "boxes": dict(self.boxes),  # Copied in one go, as the server can add boxes meanwhile.
+                },
+                catalog_json,
+                separators=(",", ":"),
+            )
+        os.replace(temp_file, self.catalog_file)
+        self.dirty = False
+
+    def refresh(self):
+        """
+        Incrementally syncs the catalog against the Nude, Clothed and Entry_Values folders.
+        :return: None
+        """
+        for kind, kind_dir in (
+            ("nude", script_globals.char_dir_nude),
+            ("clothed", script_globals.char_dir_clothed),
+        ):
+            seen = set()
+            known_dirs = {entry["dir"]: key for key, entry in self.chars.items()}
+            for dir_entry in sorted(os.scandir(kind_dir), key=lambda d: d.name):
+                if not dir_entry.is_dir():
+                    continue
+                key = known_dirs.get(dir_entry.name)
+                if key is None:
+                    try:
+                        key = str(csl.char_entry_value_strip(dir_entry.name))
+                    except AttributeError:
+                        continue  # No character number in the folder name, not one of ours.
+                if key in seen:
+                    continue  # First folder wins, same as listdir_int_match.
+                seen.add(key)
+                entry = self.chars.setdefault(
+                    key, {"dir": dir_entry.name, "nude": [], "clothed": [], "mtime": {}}
+                )
+                dir_mtime = dir_entry.stat().st_mtime_ns
+                if entry["mtime"].get(kind) == dir_mtime and entry["dir"] == dir_entry.name:
+                    continue
+                entry["dir"] = dir_entry.name
+                entry[kind] = sorted(
+                    file_entry.name
+                    for file_entry in os.scandir(dir_entry.path)
+                    if file_entry.name.endswith(".png")
+                )
+                entry["mtime"][kind] = dir_mtime
+                self.dirty = True
+            for key, entry in self.chars.items():
+                if key not in seen and (entry[kind] or kind in entry["mtime"]):
+                    entry[kind] = []
+                    entry["mtime"].pop(kind, None)
+                    self.dirty = True
+
+        entry_values = {file_entry.name for file_entry in os.scandir(script_globals.char_dir_entry)}
+        for key in list(self.chars):
+            entry = self.chars[key]
+            if not entry["nude"] and not entry["clothed"]:
+                del self.chars[key]
+                self.dirty = True
+                continue
+            has_entry = f"{key}.png" in entry_values
+            if entry.get("entry") != has_entry:
+                entry["entry"] = has_entry
+                self.dirty = True
+        self.save()
+
+    def check_source(self, image_path):
+        """
+        Fingerprints a sheet in Originals. mtime+size is checked first, and the file is only read and hashed
+        when those differ from what was recorded. Sheets that were taken out of Originals and put back are
+        checked against what they were last cut from, same as any other.
+        :param image_path: Path to the source sheet.
+        :return: "new", "changed" or "unchanged", and the content hash (None if never needed).
+        """
+        stat = image_path.stat()
+        record = self.sources.get(image_path.name)
+        if record and record.pop("missing", False):
+            self.dirty = True
+        if record and record["mtime"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+            return "unchanged", record.get("hash")
+        digest = file_digest(image_path)
+        if record is None:
+            return "new", digest
+        if record.get("hash") == digest:
+            # Touched, or copied over with the same content. Nothing to re-cut.
+            record["mtime"] = stat.st_mtime_ns
+            record["size"] = stat.st_size
+            self.dirty = True
+            return "unchanged", digest
+        return "changed", digest
+
+    def record_source(self, image_path, digest, outputs):
+        """
+        Remembers which sheet in Originals sprites were cut from, and its fingerprint at the time.
+        :param image_path: Path to the source sheet.
+        :param digest: Content hash of the sheet.
+        :param outputs: List of files cut from the sheet, relative to Character_Lists.
+        :return: None
+        """
+        stat = image_path.stat()
+        self.sources[image_path.name] = {
+            "char": csl.char_entry_value_strip(image_path.stem),
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "hash": digest,
+            "outputs": sorted(outputs),
+        }
+        self.dirty = True
+
+    def adopt_source(self, image_path, digest):
+        """
+        For sheets cut before fingerprints were kept. Works out which existing sprites came from the sheet by
+        name, so they can still be invalidated if the sheet changes later.
+        :param image_path: Path to the source sheet.
+        :param digest: Content hash of the sheet.
+        :return: None
+        """
+        stem = image_path.stem
+        char_val = csl.char_entry_value_strip(stem)
+        outputs = [
+            sprite for sprite in self.sprites(char_val, True) + self.sprites(char_val, False)
+            if sprite.stem == stem
+            or (stem == self.char_dir_name(char_val) and re.fullmatch(re.escape(stem) + r"\d+", sprite.stem))
+        ]
+        if stem == self.char_dir_name(char_val) and self.entry_value(char_val):
+            outputs.append(self.entry_value(char_val))
+        self.record_source(
+            image_path, digest, [output.relative_to(script_globals.char_dir).as_posix() for output in outputs]
+        )
+
+    def invalidate_source(self, sheet_name):
+        """
+        Deletes every sprite cut from a sheet, so it can be cut again. Call refresh() afterwards.
+        :param sheet_name: File name of the sheet in Originals.
+        :return: None
+        """
+        record = self.sources.pop(sheet_name, None)
+        if not record:
+            return
+        for output in record.get("outputs", []):
+            self.boxes.pop(output, None)
+            stale = script_globals.char_dir / output
+            if stale.exists():
+                stale.unlink()
+                logging.info("Removed stale sprite %s", output)
+        self.dirty = True
+
+    def mark_missing_sources(self, present_names):
+        """
+        Flags fingerprints of sheets no longer in Originals. Their sprites are kept, and so is the fingerprint, so
+        a sheet that comes back re-exported under the same name is still re-cut (see check_source), rather than
+        taken for one cut before fingerprints were kept.
+        :param present_names: Set of file names currently in Originals.
+        :return: None
+        """
+        for sheet_name, record in self.sources.items():
+            if sheet_name not in present_names and not record.get("missing"):
+                record["missing"] = True
+                self.dirty = True
+
+    def lookup(self, char_val):
+        """
+        :param char_val: Int, character entry number.
+        :return: Catalog entry (dict), or None if unknown.
+        """
+        return self.chars.get(str(char_val))
+
+    def char_values(self, kind="nude"):
+        """
+        :param kind: "nude" or "clothed".
+        :return: Sorted list of character numbers that have at least one sprite of that kind.
+        """
+        return sorted(int(key) for key, entry in self.chars.items() if entry[kind])
+
+    def char_dir_name(self, char_val):
+        entry = self.lookup(char_val)
+        return entry["dir"] if entry else None
+
+    def sprites(self, char_val, nude):
+        """
+        :param char_val: Int, character entry number.
+        :param nude: Boolean. Nude sprites if True, clothed variants otherwise.
+        :return: List of sprite paths, empty if none.
+        """
+        entry = self.lookup(char_val)
+        if not entry:
+            return []
+        if nude:
+            return [script_globals.char_dir_nude / entry["dir"] / name for name in entry["nude"]]
+        return [script_globals.char_dir_clothed / entry["dir"] / name for name in entry["clothed"]]
+
+    def entry_value(self, char_val):
+        entry = self.lookup(char_val)
+        if entry and entry.get("entry"):
+            return script_globals.char_dir_entry / f"{char_val}.png"
+        return None
+
+    def known_stems(self, kind):
+        """
+        Stand-in for globbing a whole Character_Lists folder. Includes the folder names, as the pre-cut step
+        leaves an empty marker file named after the folder in each.
+        :param kind: "nude" or "clothed".
+        :return: Set of file stems.
+        """
+        stems = set()
+        for entry in self.chars.values():
+            if entry[kind]:
+                stems.add(entry["dir"])
+                stems.update(name[:-4] for name in entry[kind])
+        return stems
+
+
+class SheetReader:
+    """
+    Lazy reader for sheets in Originals. Opening one only reads the header, so badly sized sheets are turned away
+    without being decoded. PNG rows are compressed one after the other, so a region can't be decoded on its own,
+    but decoding can stop early: only the rows asked for are decoded. e.g. 100 rows for an entry value, rather
+    than the whole sheet, or just the first 1600 of a sheet taller than that.
+    """
+
+    def __init__(self, sheet_path):
+        self.sheet_path = Path(sheet_path)
+        with Image.open(self.sheet_path) as header:
+            self.width, self.height = header.size
+        self.decoded = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.decoded = None
+
+    def valid(self):
+        return not (self.width % 1200 or self.height % 1600)
+
+    def top(self, rows):
+        """
+        Decodes the sheet down to `rows`. Decoded rows are kept, so asking again (for as many or fewer) is free.
+        :param rows: Int, rows needed from the top.
+        :return: RGB or RGBA Image, `rows` tall.
+        """
+        rows = min(rows, self.height)
+        if self.decoded is None or self.decoded.height < rows:
+            tracer.count("images_decoded")
+            image = Image.open(self.sheet_path)
+            cut_short = self.cut_short(image, rows)
+            try:
+                image.load()
+            except (OSError, ValueError, SystemError):
+                if not cut_short:
+                    raise
+                image = None
+            if cut_short and (image is None or image.size != (self.width, rows)):
+                # Pillow didn't take the shortcut. Decode all of it, the crop below still hands back `rows`.
+                logging.info("Decoding all of %s, it couldn't be cut short.", self.sheet_path.name)
+                image = Image.open(self.sheet_path)
+                image.load()
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            self.decoded = image
+        if self.decoded.height > rows:
+            return self.decoded.crop((0, 0, self.width, rows))
+        return self.decoded
+
+    @staticmethod
+    def cut_short(image, rows):
+        """
+        Shrinks an opened (not yet loaded) PNG, and its one tile, to its top `rows`, so load() stops there.
+        Pillow has no API for this, so it's done through Image._size and the tile list. Anything that doesn't look
+        the way that expects is left alone, and top() decodes the whole sheet and crops instead.
+        :param image: Image fresh from Image.open.
+        :param rows: Int, rows wanted.
+        :return: Bool, whether it was shrunk.
+        """
+        if image.format != "PNG" or image.info.get("interlace") or rows >= image.height:
+            return False
+        if len(image.tile) != 1 or not isinstance(getattr(image, "_size", None), tuple):
+            return False
+        tile = image.tile[0]
+        if len(tile) != 4 or tuple(tile[1]) != (0, 0, image.width, image.height):
+            return False
+        codec, _, offset, args = tile
+        image._size = (image.width, rows)
+        image.tile = [(codec, (0, 0, image.width, rows), offset, args)]
+        return True
+
+    def region(self, box):
+        """
+        :param box: (left, upper, right, lower), same as Image.crop.
+        :return: Image of that region. Only rows down to `lower` get decoded.
+        """
+        return self.top(box[3]).crop(box)
+
+
 # Shared re-usable functions
+def file_digest(file_path):
+    """
+    Content hash of a file, read in chunks so big sheets don't need to sit in memory.
+    :param file_path: Path to hash.
+    :return: Hex digest string.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as hashed_file:
+        for chunk in iter(lambda: hashed_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def file_finder(char_val):  # , nude):
     """
     Finds if a file exists or not.
@@ -48,18 +682,12 @@ def file_finder(char_val):  # , nude):
     :return: v1 for loop breaking if found, and which file matched.
     """
     v1 = False
-    entry = ""
-    # if nude:
-    char_dir = sorted(script_globals.char_dir_nude.glob("*"))
-    # else:
-    #     char_dir = script_globals.char_dir_clothed.walk()
-    for i in char_dir:
-        entry = i.name
-        test_against = csl.char_entry_value_strip(entry)
-        if char_val == test_against:
-            print(f"Character sheet no. {char_val} found!")
-            v1 = True
-            break
+    entry = script_globals.catalog.char_dir_name(char_val)
+    if entry and script_globals.catalog.sprites(char_val, True):
+        print(f"Character sheet no. {char_val} found!")
+        v1 = True
+    else:
+        entry = ""
     logging.info(entry)
     return v1, entry
 
@@ -104,6 +732,34 @@ def image_validation(clothed_check, i=-1):
     return file_name, file_path, file_found
 
 
+def option_strip(sys_args):
+    """
+    Pulls long options (see cli_options) out of the arg list, and sets them on script_globals.
+    Accepts both "--name value" and "--name=value". Options typed bool are flags, and take no value.
+    :param sys_args: List of args, usually sys.argv.
+    :return: List of args left over.
+    """
+    remaining = []
+    args = iter(sys_args)
+    for arg in args:
+        name, has_value, value = arg.partition("=")
+        if name not in cli_options:
+            remaining.append(arg)
+            continue
+        attr, cast = cli_options[name]
+        if cast is bool:
+            setattr(script_globals, attr, True)
+            continue
+        if not has_value:
+            value = next(args, None)
+        try:
+            setattr(script_globals, attr, cast(value))
+        except (TypeError, ValueError):
+            logging.warning("Arguments malformed. %s expects a value of type %s.", name, cast.__name__)
+            sys.exit()
+    return remaining
+
+
 # Step 1
 def folder_setup():
     """
@@ -116,8 +772,13 @@ def folder_setup():
         script_globals.char_dir_clothed,
         script_globals.output_dir,
         script_globals.char_dir_entry,
+        script_globals.render_cache_dir,
     ]
 
+    if script_globals.preview not in (0, *preview_factors):
+        logging.warning("--preview takes 2, 4 or 8, for a 1/2, 1/4 or 1/8 scale lineup.")
+        sys.exit()
+
     if not script_globals.original_images_dir.exists():
         logging.warning(
             "Missing original images source. Please make a folder called 'Originals' in the same place as this file, "
@@ -130,171 +791,519 @@ def folder_setup():
         if not directory.exists():
             os.makedirs(directory)
 
+    script_globals.catalog = SpriteCatalog(script_globals.catalog_file)
+    script_globals.catalog.refresh()
+    script_globals.sprite_cache = SpriteCache(script_globals.cache_mb)
+    script_globals.render_cache = RenderCache(
+        script_globals.render_cache_dir, script_globals.render_cache_mb, script_globals.render_cache_days
+    )
+    if script_globals.use_sprite_store:
+        script_globals.sprite_store = SpriteStore(script_globals.sprite_store_file, script_globals.sprite_store_index)
+    if script_globals.incremental:
+        script_globals.row_cache_dir.mkdir(exist_ok=True)
+        script_globals.row_cache = RowCache(
+            script_globals.row_cache_dir, script_globals.row_cache_mb, script_globals.render_cache_days
+        )
+    script_globals.decode_pool = make_decode_pool()
+
+
+def make_decode_pool(decode_workers=None):
+    """
+    The thread pool decode_rows decodes sprites on. Shared by every lineup being built at once (--split pages,
+    --serve requests), so threads stay bounded.
+    :param decode_workers: Int, threads. Defaults to --decode-workers (one per CPU if 0).
+    :return: ThreadPoolExecutor, or None for a single worker, in which case sprites are decoded by the compositor.
+    """
+    decode_workers = decode_workers or script_globals.decode_workers or os.cpu_count() or 1
+    if decode_workers <= 1:
+        return None
+    return concurrent.futures.ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="decode")
+
 
 # Step 2
-def preprocess_files():
+def preprocess_files(image_paths=None):
     """
     Pre-cuts new images and sorts them into respective files based on expected type.
-    :return: None
+    Each sheet is fingerprinted, so unchanged sheets are skipped without being opened, and sheets re-exported
+    under the same name have their old sprites thrown out and re-cut.
+    :param image_paths: Only check these sheets, rather than all of Originals. Used by --watch.
+    :return: List of sheets that were cut.
     """
-    unmodified_images = sorted(
-        [i for i in script_globals.original_images_dir.glob("*.png")]
-    )
-    known_nudes = sorted(script_globals.char_dir_nude.glob("*"))
-    known_clothed = sorted(script_globals.char_dir_clothed.glob("*"))
-    unmodified_images_int_only = []
-    known_nudes_filenames = [path1.stem for path1 in known_nudes]
-    known_clothed_filenames = [
-        file_path.stem
-        # for file_path2 in list(known_clothed.rglob("*"))
-        for path2 in known_clothed
-        for file_path in path2.glob("*")
-    ]
-    # Path doesn't exist on first run with multi-costume. It's okay, we can just get the expected file_dir from
-    # original.
-    clothed_pre_creation_check = sorted(script_globals.char_dir_clothed.glob("*"))
-    if not clothed_pre_creation_check:
-        clothed_pre_creation_check = sorted(
-            script_globals.original_images_dir.glob("*")
+    catalog = script_globals.catalog
+    if image_paths is None:
+        unmodified_images = sorted(
+            [i for i in script_globals.original_images_dir.glob("*.png")]
         )
+        catalog.mark_missing_sources({image_path.name for image_path in unmodified_images})
+    else:
+        unmodified_images = sorted(image_paths)
+    known_filenames = catalog.known_stems("nude") | catalog.known_stems("clothed")
+    digests = {}
+
+    for image_path in unmodified_images:
+        state, digest = catalog.check_source(image_path)
+        if state == "new" and image_path.stem in known_filenames:
+            # Cut before fingerprints were kept (a sheet that ever had one is "changed" or "unchanged" instead).
+            # Nothing to do, just start tracking it.
+            catalog.adopt_source(image_path, digest)
+        elif state == "changed":
+            logging.info("%s has changed since it was last cut. Re-cutting.", image_path.name)
+            catalog.invalidate_source(image_path.name)
+            digests[image_path] = digest
+        elif state == "new":
+            digests[image_path] = digest
+    if not digests:
+        catalog.save()
+        if image_paths is None:
+            restore_entry_values()
+        return []
+    catalog.refresh()
+
+    claimed_chars = set()
     entry_exists = []
     process_list = []
+    for image_path in digests:
+        char_val = csl.char_entry_value_strip(image_path.stem)
+        # Fresh entry, no nudes. First sheet of a char (by name) becomes its folder and nude.
+        if not catalog.sprites(char_val, True) and char_val not in claimed_chars:
+            claimed_chars.add(char_val)
+            process_list.append([image_path, True, None])
+        # Char has extra costumes, which go in the folder of the first sheet.
+        else:
+            entry_exists.append([image_path, False])
+
+    results = process_list_dispatch(process_list)  # looped
+    # Extra costumes are saved into the folders made above, so the catalog needs to know about them first.
+    catalog.refresh()
+    for work in entry_exists:
+        work.append(catalog.char_dir_name(csl.char_entry_value_strip(work[0].stem)))
+    results += process_list_dispatch(entry_exists)
+    cut = []
+    for work, result in zip(process_list + entry_exists, results):
+        if result:
+            catalog.record_source(work[0], digests[work[0]], result["outputs"])
+            catalog.boxes.update(result["boxes"])
+            if script_globals.png_level < 9:
+                catalog.recompress += result["outputs"]
+            cut.append(work[0])
+    catalog.refresh()
+    if image_paths is None:
+        restore_entry_values()
+    if script_globals.sprite_store is not None:
+        script_globals.sprite_store.save()
+    return cut
+
+
+def restore_entry_values():
+    """
+    Re-extracts entry values that have gone missing from Entry_Values, for characters whose first sheet is still
+    in Originals. Only the top 100 rows of the sheet get decoded for it (see SheetReader).
+    :return: None
+    """
+    catalog = script_globals.catalog
+    restored = False
+    for key, entry in catalog.chars.items():
+        sheet_path = script_globals.original_images_dir / f"{entry['dir']}.png"
+        if not entry["nude"] or entry.get("entry") or not sheet_path.exists():
+            continue
+        with SheetReader(sheet_path) as sheet:
+            if not sheet.valid():
+                continue
+            entry_value = char_entry_img_extract(sheet.region(entry_label_box), entry["dir"])
+        record = catalog.sources.get(sheet_path.name)
+        if record:
+            record["outputs"] = sorted(
+                set(record["outputs"])
+                | {output.relative_to(script_globals.char_dir).as_posix() for output in entry_value}
+            )
+        logging.info("Restored the entry value for %s.", entry["dir"])
+        restored = True
+    if restored:
+        catalog.dirty = True
+        catalog.refresh()
 
-    for image_path in unmodified_images:
-        checking_filename = image_path.stem
-        char_val = csl.char_entry_value_strip(checking_filename)
-
-        # Fresh entry, no nudes/clothes
-        if (
-            checking_filename not in known_nudes_filenames
-            and checking_filename not in known_clothed_filenames
-            and char_val not in unmodified_images_int_only
-        ):
-            unmodified_images_int_only.append(char_val)
-            process_list.append([image_path, True])
 
-        # Char is run once already, has an entry, but may be having extra costumes.
-        elif checking_filename in known_nudes and (
-            char_val not in unmodified_images_int_only
-        ):
-            unmodified_images_int_only.append(char_val)
+def recompress_sprites(time_budget=None):
+    """
+    Re-saves sprites that were cut at a quick --png-level at level 9, the smallest. Pixels don't change, only the
+    file size, so the mtime is carried over and sprite store records are kept. Run with
+    python mainv2.py recompress-sprites, or while idle by --watch with --recompress-idle.
+    :param time_budget: Seconds to stop after (roughly). None to go through all of them.
+    :return: Number of sprites left to do.
+    """
+    catalog = script_globals.catalog
+    sprite_store = script_globals.sprite_store
+    if sprite_store is None and script_globals.sprite_store_index.exists():
+        sprite_store = SpriteStore(script_globals.sprite_store_file, script_globals.sprite_store_index)
+
+    def recompress(output):
+        sprite_path = script_globals.char_dir / output
+        if not sprite_path.exists():
+            return 0
+        old_stat = sprite_path.stat()
+        temp_path = sprite_path.with_name(f"{sprite_path.name}.tmp")
+        with Image.open(sprite_path) as sprite_image:
+            sprite_image.save(temp_path, "PNG", compress_level=9)
+        if temp_path.stat().st_size >= old_stat.st_size:
+            temp_path.unlink()
+            return 0
+        # Same pixels, so it keeps the old mtime. The render and row caches, and previews, all still hold.
+        os.utime(temp_path, ns=(old_stat.st_atime_ns, old_stat.st_mtime_ns))
+        os.replace(temp_path, sprite_path)
+        if sprite_store is not None:
+            sprite_store.restat(sprite_path, old_stat)
+        return old_stat.st_size - sprite_path.stat().st_size
+
+    start = time.perf_counter()
+    saved_bytes = 0
+    done = 0
+    workers = os.cpu_count() or 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while catalog.recompress:
+            if time_budget is not None and time.perf_counter() - start > time_budget:
+                break
+            batch = catalog.recompress[:workers]
+            for output, result in zip(batch, executor.map(recompress, batch)):
+                saved_bytes += result
+            del catalog.recompress[:len(batch)]
+            done += len(batch)
+            catalog.dirty = True
+    catalog.refresh()
+    if sprite_store is not None:
+        sprite_store.save()
+    if done:
+        logging.info(
+            "Recompressed %s sprites in %.2fs, %.1f MB saved. %s left.",
+            done,
+            time.perf_counter() - start,
+            saved_bytes / (1024 * 1024),
+            len(catalog.recompress),
+        )
+    return len(catalog.recompress)
+
+
+# Where the entry number sits on a sheet and its sprites. (left, top, right, bottom)
+entry_label_box = (0, 0, 125, 100)
+
+
+def off_background(pixels, corners, tolerance):
+    """
+    :param pixels: Numpy array, (panels, ..., C).
+    :param corners: Top left pixel of each panel, (panels, 1, 1, C). Panels of one flat colour count as blank,
+    same as csl.background_only.
+    :param tolerance: Int, max per-channel difference to still match a background colour.
+    :return: Boolean array, (panels, ...). True where the pixel isn't background.
+    """
+    # Channel by channel, as reducing over the tiny channel axis is far slower than a few elementwise passes.
+    off = pixels[..., 0] != corners[..., 0]
+    for channel in range(1, pixels.shape[-1]):
+        off |= pixels[..., channel] != corners[..., channel]
+    if not off.any():
+        return off
+
+    # Only pixels that differ from the corner need checking against the background colours.
+    candidates = pixels[off].astype(np.int16)
+    matched = np.zeros(len(candidates), dtype=bool)
+    for colour in script_globals.bg_colours:
+        colour_match = np.ones(len(candidates), dtype=bool)
+        for channel in range(pixels.shape[-1]):
+            colour_match &= np.abs(candidates[:, channel] - colour[channel]) <= tolerance
+        matched |= colour_match
+    off[off] = ~matched
+    return off
+
+
+def populated_panels(sheet_array, tolerance=None, sample_step=None):
+    """
+    Checks every 1200px panel of a sheet for a character in one go, rather than cropping each out first.
+    A strided sample is checked first, which catches almost every populated panel. Only panels that look blank
+    there get the full check, in row chunks, stopping as soon as a character is found.
+    :param sheet_array: Numpy array of the whole sheet, H x (1200 * panels) x C.
+    :param tolerance: Int. Defaults to script_globals.bg_tolerance.
+    :param sample_step: Int. Defaults to script_globals.bg_sample_step.
+    :return: List of booleans, one per panel. True if a character is on it.
+    """
+    tolerance = script_globals.bg_tolerance if tolerance is None else tolerance
+    sample_step = script_globals.bg_sample_step if sample_step is None else sample_step
+    sheet_array = sheet_array[:1600]
+    height, width, channels = sheet_array.shape
+    # (panels, 1600, 1200, C) view over the sheet. No copying.
+    panels = sheet_array.reshape(height, width // 1200, 1200, channels).transpose(1, 0, 2, 3)
+    corners = panels[:, :1, :1, :]
+    populated = off_background(panels[:, ::sample_step, ::sample_step], corners, tolerance).any(axis=(1, 2))
+
+    undecided = np.flatnonzero(~populated)
+    for row in range(0, height, 200):
+        if not undecided.size:
+            break
+        found = off_background(
+            panels[undecided, row:row + 200], corners[undecided], tolerance
+        ).any(axis=(1, 2))
+        populated[undecided[found]] = True
+        undecided = undecided[~found]
+    return populated.tolist()
+
 
-        # Char has extra costumes. Folder uses first known image, so future new costumes should never match.
+def content_boxes(panels, tolerance=None):
+    """
+    Bounding box of what isn't background on each panel. Each panel is checked against bg_colours in one pass
+    (see off_background), and the box read off the row and column projections of that. The entry number in the top
+    left corner (entry_label_box) is left out, so it doesn't stretch every box up to the corner; --trim puts it
+    back.
+    :param panels: List of numpy arrays, 1600 x 1200 x C, RGB(A). Views into the sheet are fine.
+    :param tolerance: Int. Defaults to script_globals.bg_tolerance.
+    :return: List of [left, top, right, bottom] boxes, one per panel. [0, 0, 0, 0] if there's nothing but the
+    entry number.
+    """
+    tolerance = script_globals.bg_tolerance if tolerance is None else tolerance
+    left, top, right, bottom = entry_label_box
+    boxes = []
+    for panel in panels:
+        # One panel at a time, so the masks stay a couple of MB however wide the sheet is.
+        if tolerance == 0 and panel.shape[-1] == 4:
+            # Exact matches only, so each RGBA pixel can be compared whole, as one uint32. Several times quicker.
+            pixels = panel.view(np.uint32)[..., 0]
+            off = pixels != pixels[0, 0]
+            for colour in script_globals.bg_colours:
+                off &= pixels != np.array(colour, dtype=np.uint8).view(np.uint32)[0]
         else:
-            # Path doesn't exist on first run with multi-costume. It's okay, we can just get the expected file_dir from
-            # original.
-            # clothed_pre_creation_check = list(script_globals.char_dir_clothed.iterdir())
-            # if not clothed_pre_creation_check:
-            #     clothed_pre_creation_check = list(
-            #         script_globals.original_images_dir.iterdir()
-            #     )
-
-            # Path only doesn't exist on first run, and this else only for multi-costumes.
-            path_simplified = script_globals.char_dir_clothed / csl.listdir_int_match(
-                clothed_pre_creation_check, image_path.name
-            )
-            if (
-                not path_simplified.exists()
-                and not (path_simplified / image_path.name).exists()
-            ):
-                entry_exists.append([image_path, False])
-            else:
-                temp1 = sorted(path_simplified.glob("*"))
-                temp2 = image_path.name[:-4]
-                for i in range(len(temp1)):
-                    temp3 = temp1[i].name
-                    if temp2 in temp3:
-                        break
-                    elif i + 1 == len(temp1):
-                        entry_exists.append([image_path, False])
+            off = off_background(panel[None], panel[None, :1, :1, :], tolerance)[0]
+        off[top:bottom, left:right] = False
+        rows_on = np.flatnonzero(off.any(axis=1))
+        columns_on = np.flatnonzero(off.any(axis=0))
+        if not rows_on.size:
+            boxes.append([0, 0, 0, 0])
+        else:
+            boxes.append([int(columns_on[0]), int(rows_on[0]), int(columns_on[-1]) + 1, int(rows_on[-1]) + 1])
+    return boxes
 
-    # logging.warning("1")
-    csl.process_list_queue(process_list, process_image)  # looped
-    # logging.warning("2")
-    csl.process_list_queue(entry_exists, process_image)
-    # logging.warning("3")
+
+def process_list_dispatch(work_list):
+    """
+    Sends sheets off to be cut. Threads through csl.process_list_queue by default, or a process pool with --jobs N.
+    :param work_list: List of [sheet path, is first sheet of char, char folder name].
+    :return: List of results, same order as work_list. None for any sheet that failed.
+    """
+    load_now(Image, np, cv2, csl)
+    if script_globals.jobs <= 1 or len(work_list) <= 1:
+        return csl.process_list_queue(work_list, process_image) or []
+
+    if script_globals.sheet_pool is not None:
+        results = pool_results(script_globals.sheet_pool, work_list)
+    else:
+        with sheet_pool(min(script_globals.jobs, len(work_list))) as executor:
+            results = pool_results(executor, work_list)
+    if work_list:
+        print("All complete! Moving on.")
+    return results
+
+
+def sheet_pool(workers):
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=pool_initializer,
+        initargs=(pool_settings(),),
+    )
+
+
+def pool_results(executor, work_list):
+    """
+    :param executor: Process pool to cut the sheets on.
+    :param work_list: See process_list_dispatch.
+    :return: See process_list_dispatch.
+    """
+    results = []
+    futures = [executor.submit(process_sheet, work) for work in work_list]
+    for work, future in zip(work_list, futures):
+        try:
+            result = future.result()
+            if "trace" in result:
+                tracer.merge(result.pop("trace"))
+            results.append(result)
+        except Exception as f:
+            logging.error("Failed to cut %s: %s", work[0].name, f)
+            results.append(None)
+    return results
+
+
+def pool_settings():
+    """
+    Settings worker processes need from the parent. Platforms that spawn rather than fork start workers with a
+    fresh script_globals, so anything changed at runtime has to be handed over.
+    :return: Dict of script_globals attributes.
+    """
+    not_passed = ("catalog", "sprite_cache", "sprite_store", "render_cache", "row_cache", "sheet_pool", "decode_pool")
+    return {key: value for key, value in vars(script_globals).items() if key not in not_passed}
+
+
+def pool_initializer(settings):
+    vars(script_globals).update(settings)
+    # Forked workers inherit the parent's sprite store. Only the parent writes to it; the sprites these cut are
+    # added the first time they're composited instead.
+    script_globals.sprite_store = None
+    # Nor can they use the parent's decode pool. Its threads don't exist in a forked child, so anything submitted
+    # to it would never run.
+    script_globals.decode_pool = None
+    tracer.enabled = bool(script_globals.profile)
+    tracer.drain()  # Forked workers start with a copy of the parent's spans. Those aren't theirs to report.
 
 
 # noinspection PyUnusedLocal
 def process_image(q, results):
     """
-    Cutting images based on parameters.
+    Cutting images based on parameters. Thread worker for csl.process_list_queue.
     :param q: Queue. Used for keeping results in order.
     :param results: Where to store the results to return
     :return: Completed queue.
     """
     while not q.empty():
-        y01 = 0
-        y11 = 1200
         work = q.get()
         logging.info("New task started. %s", str(work[0]))
-        clothed = []
-        nude = False
-        filedir = work[1][0]
-        filename = filedir.stem
-        cycled_once = False  # First image should always be nude
-        im = Image.open(filedir)
-        if (im.width % 1200 > 0) or (im.height % 1600 > 0):
-            logging.warning(
-                "%s is not a proper sheet. Dimensions should be H = 1600, "
-                "W = 1200, or any multiple of W for character sheets. This one will be skipped.",
-                filename,
-            )
-            q.task_done()
-        for _ in range(int(im.width / 1200)):
+        try:
+            results[work[0]] = process_sheet(work[1])
+        except Exception:
+            logging.exception("Failed to cut %s", work[1][0].name)
+            results[work[0]] = None
+        q.task_done()
+        logging.info("New task done. %s", str(work[0]))
+    return True
+
+
+def process_sheet(work):
+    """
+    Cuts one sheet into its sprites, and saves them. Decodes the sheet once.
+    :param work: [sheet path, is first sheet of char, char folder name]. First sheets are split into nude and
+    clothed, the rest only give clothed variants, saved into the existing char folder.
+    :return: Dict holding the "outputs" written, and the "boxes" of the sprites among them (see content_boxes),
+    both relative to Character_Lists.
+    """
+    filedir = work[0]
+    with tracer.span("slice", sheet=filedir.name):
+        outputs, boxes = cut_sheet(work)
+    result = {
+        "outputs": [output.relative_to(script_globals.char_dir).as_posix() for output in outputs],
+        "boxes": {
+            sprite_path.relative_to(script_globals.char_dir).as_posix(): box for sprite_path, box in boxes.items()
+        },
+    }
+    if tracer.enabled and multiprocessing.parent_process() is not None:
+        result["trace"] = tracer.drain()
+    return result
+
+
+def cut_sheet(work):
+    """
+    The cutting itself, for process_sheet.
+    :param work: See process_sheet.
+    :return: List of paths written, and the content box of each sprite (see content_boxes) by path.
+    """
+    y01 = 0
+    y11 = 1200
+    clothed = []
+    clothed_boxes = []
+    nude = False
+    nude_box = None
+    filedir = work[0]
+    filename = filedir.stem
+    cycled_once = False  # First image should always be nude
+    outputs = []
+    boxes = {}
+    tracer.count("bytes_read", filedir.stat().st_size)
+    sheet = SheetReader(filedir)
+    if not sheet.valid():
+        logging.warning(
+            "%s is not a proper sheet. Dimensions should be H = 1600, "
+            "W = 1200, or any multiple of W for character sheets. This one will be skipped.",
+            filename,
+        )
+        return [], boxes
+    # Only the first 1600 rows hold sprites.
+    im = sheet.top(1600)
+    sheet_array = csl.img_to_numpy(im)
+    populated = populated_panels(sheet_array)
+    panels = sheet_array.reshape(1600, -1, 1200, sheet_array.shape[-1]).transpose(1, 0, 2, 3)
+    populated_at = np.flatnonzero(populated)
+    panel_boxes = dict(zip(populated_at, content_boxes([panels[panel] for panel in populated_at])))
+    for panel, panel_populated in enumerate(populated):
+        if panel_populated:
             im1 = im.crop((y01, 0, y11, 1600))
-            y01 = y11
-            y11 += 1200
-            # im1.show()
-            if not csl.background_only(im1):
-                if work[1][1]:
-                    if not nude:
-                        nude = im1
-                    else:
-                        clothed.append(im1)
+        y01 = y11
+        y11 += 1200
+        # im1.show()
+        if panel_populated:
+            if work[1]:
+                if not nude:
+                    nude = im1
+                    nude_box = panel_boxes[panel]
                 else:
-                    if cycled_once:
-                        clothed.append(im1)
-            cycled_once = True
-
-        # if work[1][1]:
-        #     nude = im.crop((0, 0, 1200, 1600))
-
-        if not nude:
-            char_val = csl.char_entry_value_strip(filename)
-            char_dir_2 = list(script_globals.char_dir_clothed.glob("*"))
-            char_save_dir = [
-                dir_entry
-                for dir_entry in char_dir_2
-                if char_val == csl.char_entry_value_strip(dir_entry.name)
-            ]
-            clothed[0].save(str(char_save_dir[0] / filename) + ".png", "PNG")
-
+                    clothed.append(im1)
+                    clothed_boxes.append(panel_boxes[panel])
+            else:
+                if cycled_once:
+                    clothed.append(im1)
+                    clothed_boxes.append(panel_boxes[panel])
+        cycled_once = True
+
+    # if work[1]:
+    #     nude = im.crop((0, 0, 1200, 1600))
+
+    if not nude and not clothed:
+        logging.warning("%s has no character sprites on it. Skipped.", filename)
+
+    elif not nude:
+        char_dir_name = work[2]
+        if char_dir_name:
+            char_save_dir = script_globals.char_dir_clothed / char_dir_name
+            clothed[0].save(str(char_save_dir / filename) + ".png", "PNG", compress_level=script_globals.png_level)
+            sprite_path = char_save_dir / f"{filename}.png"
+            outputs.append(sprite_path)
+            boxes[sprite_path] = clothed_boxes[0]
+            tracer.count("bytes_written", sprite_path.stat().st_size)
+            sprite_array = csl.img_to_numpy(clothed[0])
+            if script_globals.sprite_store is not None:
+                script_globals.sprite_store.put(sprite_path, sprite_array)
+            outputs += save_previews(sprite_array, sprite_path)
         else:
-            run_this = [
-                [nude, script_globals.char_dir_nude],
-                [clothed, script_globals.char_dir_clothed],
-            ]
-            ran_once = False
-            counter = 0
-            for i in run_this:
-                if isinstance(i[0], list):
-                    for j in i[0]:
-                        process_image_2(j,i[1],filename, filename + str(counter))
-                        counter += 1
-                else:
-                    process_image_2(i[0], i[1], filename)
-                if not ran_once:
-                    char_entry_img_extract(i[0], filename)
-                    ran_once = True
+            logging.warning("%s is an extra costume, but character has no folder to go in.", filename)
 
-        q.task_done()
-        logging.info("New task done. %s", str(work[0]))
-    return True
+    else:
+        run_this = [
+            [nude, script_globals.char_dir_nude, nude_box],
+            [clothed, script_globals.char_dir_clothed, clothed_boxes],
+        ]
+        ran_once = False
+        counter = 0
+        for i in run_this:
+            if isinstance(i[0], list):
+                for j, box in zip(i[0], i[2]):
+                    saved = process_image_2(j,i[1],filename, filename + str(counter))
+                    if saved:
+                        boxes[saved[0]] = box
+                    outputs += saved
+                    counter += 1
+            else:
+                saved = process_image_2(i[0], i[1], filename)
+                if saved:
+                    boxes[saved[0]] = i[2]
+                outputs += saved
+            if not ran_once:
+                with tracer.span("entry_extraction", sheet=filedir.name):
+                    outputs += char_entry_img_extract(i[0], filename)
+                ran_once = True
+
+    return outputs, boxes
 
 
 # noinspection PyBroadException
 def process_image_2(char_sprite, image_dir, filebasedir, altclothes = ""):
+    """
+    Saves a cut sprite into its character folder.
+    :param char_sprite: Image to save.
+    :param image_dir: Nude or Clothed dir.
+    :param filebasedir: Character folder name.
+    :param altclothes: File name for clothed variants. Defaults to the folder name.
+    :return: List of paths written. The sprite first, then its previews (see save_previews).
+    """
     try:
         # Construct the full path including the filename
         char_dir_exists = Path(image_dir) / filebasedir
@@ -308,22 +1317,26 @@ def process_image_2(char_sprite, image_dir, filebasedir, altclothes = ""):
             char_dir_exists.chmod(0o755)  # Adjust permissions as needed
 
         # Save the image inside the directory
-        if altclothes:
-            char_sprite.save(str(char_dir_exists / altclothes) + ".png", "PNG")
-        else:
-            char_sprite.save(str(char_dir_exists / filebasedir) + ".png", "PNG")
+        sprite_path = Path(str(char_dir_exists / (altclothes or filebasedir)) + ".png")
+        char_sprite.save(sprite_path, "PNG", compress_level=script_globals.png_level)
+        tracer.count("bytes_written", sprite_path.stat().st_size)
+        sprite_array = csl.img_to_numpy(char_sprite)
+        if script_globals.sprite_store is not None:
+            script_globals.sprite_store.put(sprite_path, sprite_array)
         filemade = open(char_dir_exists/filebasedir, "w")
         filemade.close()
+        return [sprite_path] + save_previews(sprite_array, sprite_path)
     except Exception:
         logging.exception("Error: ")
+        return []
 
 
 def char_entry_img_extract(img_base, filename2):
     """
     Extracts the char entry number as pixels in the top left, and saves them for separate use.
-    :return: None
+    :return: List holding the entry value path, if it was written.
     """
-    char_sheet_init_dim = (0, 0, 125, 100)
+    char_sheet_init_dim = entry_label_box
     target_color = np.array(script_globals.bg_colours[0])
     filename = (
         script_globals.char_dir_entry / f"{csl.char_entry_value_strip(filename2)}.png"
@@ -337,7 +1350,235 @@ def char_entry_img_extract(img_base, filename2):
         image_array[mask, 3] = 0
         modified_image = Image.fromarray(image_array)
         modified_image.save(filename, "PNG")
+        tracer.count("bytes_written", os.stat(filename).st_size)
         # logging.info("%s character sheet number has been extracted and saved.", filename2)
+        return [filename]
+    return []
+
+
+# Scales sprites get previews at, as in 1/2, 1/4 and 1/8. Sprites are 1200x1600, so these all come out exact.
+preview_factors = (2, 4, 8)
+
+
+def preview_path(sprite_path, factor):
+    """
+    :param sprite_path: Path to a sprite under Character_Lists.
+    :param factor: One of preview_factors.
+    :return: Where its preview goes, e.g. Character_Lists/Previews/1_4/Nude/001Alice/001Alice.png. Kept out of the
+    character folders so the catalog doesn't take previews for sprites.
+    """
+    return script_globals.preview_dir / f"1_{factor}" / Path(sprite_path).relative_to(script_globals.char_dir)
+
+
+def save_previews(sprite, sprite_path):
+    """
+    Saves the 1/2, 1/4 and 1/8 scale versions of a sprite, for --preview. Each is area-resampled from the one
+    before it, so the whole set costs less than the first.
+    :param sprite: Decoded RGB(A) numpy array, full size.
+    :param sprite_path: Path the sprite was saved to.
+    :return: List of preview paths written.
+    """
+    written = []
+    smaller = sprite
+    previous_factor = 1
+    for factor in preview_factors:
+        step = factor // previous_factor
+        smaller = cv2.resize(
+            smaller, (smaller.shape[1] // step, smaller.shape[0] // step), interpolation=cv2.INTER_AREA
+        )
+        previous_factor = factor
+        path = preview_path(sprite_path, factor)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Via a temp file, as two lineups can want the same missing preview at once (see preview_sprite).
+        temp_path = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        Image.fromarray(smaller).save(temp_path, "PNG", compress_level=script_globals.png_level)
+        os.replace(temp_path, path)
+        tracer.count("bytes_written", path.stat().st_size)
+        written.append(path)
+    return written
+
+
+def preview_sprite(sprite, factor):
+    """
+    What --preview builds lineups from, in place of a sprite. Previews are made when sprites are cut; sprites cut
+    before that, or changed since their previews were made, get them made here.
+    :param sprite: Path to the sprite png, or an open Image.
+    :param factor: One of preview_factors.
+    :return: Path to the preview png, or a shrunk Image if given one.
+    """
+    if isinstance(sprite, Image.Image):
+        return sprite.reduce(factor)
+    path = preview_path(sprite, factor)
+    try:
+        if path.stat().st_mtime_ns >= os.stat(sprite).st_mtime_ns:
+            return path
+    except FileNotFoundError:
+        pass
+    save_previews(decode_sprite(sprite), sprite)
+    return path
+
+
+# Watch mode
+class OriginalsWatcher:
+    """
+    Reports sheets in Originals that were added, changed or removed. Uses inotify on Linux, and falls back to
+    re-scanning the folder every watch_interval seconds anywhere else.
+    """
+
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_DELETE = 0x200
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.snapshot = self.scan()
+        self.inotify_fd = None
+        if not script_globals.watch_poll:
+            try:
+                self.inotify_fd = self.inotify_setup()
+            except (OSError, AttributeError, TypeError) as f:
+                logging.info("inotify not available (%s). Polling Originals instead.", f)
+
+    def scan(self):
+        """
+        :return: Dict of sheet name -> (mtime, size), for every png in the folder.
+        """
+        snapshot = {}
+        for dir_entry in os.scandir(self.directory):
+            if dir_entry.name.endswith(".png") and dir_entry.is_file():
+                stat = dir_entry.stat()
+                snapshot[dir_entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def inotify_setup(self):
+        """
+        Straight to libc, so no extra packages are needed. Raises on anything that isn't Linux.
+        :return: inotify file descriptor.
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_DELETE
+        if libc.inotify_add_watch(inotify_fd, os.fsencode(self.directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(inotify_fd)
+            raise OSError(errno, "inotify_add_watch failed")
+        return inotify_fd
+
+    def poll(self, timeout):
+        """
+        Waits up to timeout seconds for something to happen in the folder.
+        :param timeout: Seconds.
+        :return: Set of sheet names added or changed, and whether any were removed.
+        """
+        if self.inotify_fd is None:
+            time.sleep(timeout)
+            current = self.scan()
+            changed = {name for name, stat in current.items() if self.snapshot.get(name) != stat}
+            removed = bool(self.snapshot.keys() - current.keys())
+            self.snapshot = current
+            return changed, removed
+
+        changed = set()
+        removed = False
+        ready, _, _ = select.select([self.inotify_fd], [], [], timeout)
+        if not ready:
+            return changed, removed
+        data = os.read(self.inotify_fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            # struct inotify_event: int wd, uint32 mask, uint32 cookie, uint32 len, char name[len]
+            _, mask, _, name_length = struct.unpack_from("iIII", data, offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 + name_length].rstrip(b"\0"))
+            offset += 16 + name_length
+            if not name.endswith(".png"):
+                continue
+            if mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                changed.discard(name)
+                removed = True
+            else:
+                changed.add(name)
+        return changed, removed
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+
+def watch_originals():
+    """
+    --watch. Runs until interrupted, cutting sheets as they land in Originals. A sheet is only cut once it has
+    gone watch_debounce seconds without changing, so half-copied files are left alone. The catalog stays loaded
+    the whole time, and is saved after every batch, so lineups made in the meantime start straight away.
+    With --jobs N the process pool is kept alive between batches.
+    :return: None
+    """
+    catalog = script_globals.catalog
+    watcher = OriginalsWatcher(script_globals.original_images_dir)
+    if script_globals.jobs > 1:
+        script_globals.sheet_pool = sheet_pool(script_globals.jobs)
+    pending = {}  # Sheet name -> when it last changed
+    last_busy = time.monotonic()
+    print(f"Watching {script_globals.original_images_dir} for new sheets. Ctrl+C to stop.")
+    try:
+        while True:
+            if pending:
+                timeout = max(
+                    0.05, min(pending.values()) + script_globals.watch_debounce - time.monotonic()
+                )
+            else:
+                timeout = script_globals.watch_interval
+            changed, removed = watcher.poll(timeout)
+            now = time.monotonic()
+            for name in changed:
+                pending[name] = now
+            if changed or removed:
+                last_busy = now
+            elif (
+                script_globals.recompress_idle
+                and not pending
+                and catalog.recompress
+                and now - last_busy >= script_globals.recompress_idle_after
+            ):
+                # A few seconds at a time, so new sheets don't wait long.
+                recompress_sprites(time_budget=2)
+                continue
+            if removed:
+                catalog.mark_missing_sources(set(watcher.scan()))
+                catalog.save()
+
+            settled = sorted(
+                name for name, changed_at in pending.items() if now - changed_at >= script_globals.watch_debounce
+            )
+            if not settled:
+                continue
+            for name in settled:
+                del pending[name]
+            image_paths = [
+                script_globals.original_images_dir / name
+                for name in settled
+                if (script_globals.original_images_dir / name).exists()
+            ]
+            start = time.perf_counter()
+            with tracer.span("watch_batch", sheets=len(image_paths)):
+                cut = preprocess_files(image_paths)
+            last_busy = time.monotonic()
+            if cut:
+                logging.info(
+                    "Cut %s in %.2fs. %s characters ready.",
+                    ", ".join(image_path.name for image_path in cut),
+                    time.perf_counter() - start,
+                    len(catalog.chars),
+                )
+    finally:
+        watcher.close()
+        if script_globals.sheet_pool is not None:
+            script_globals.sheet_pool.shutdown(cancel_futures=True)
+            script_globals.sheet_pool = None
 
 
 # Step 2.5
@@ -367,7 +1608,7 @@ def begin_interface_opt():
 def request_images():
     """
     User inputs.
-    :return: master_list: List of images to grab,
+    :return: master_list: List of sprite paths to grab,
     file_mashup_name: Name of file to save merged as.
     """
     while True:
@@ -375,7 +1616,7 @@ def request_images():
             char_count = int(
                 input(
                     f"How many characters do you want to merge? Integers only! You currently have "
-                    f"{len(list(script_globals.char_dir_nude.glob('*')))} characters in your list. Put the same number "
+                    f"{len(script_globals.catalog.char_values())} characters in your list. Put the same number "
                     f"in to run auto-nude!: "
                 )
             )
@@ -385,8 +1626,8 @@ def request_images():
         except ValueError:
             logging.warning("Invalid input. Please enter an integer.")
 
-    char_dir_nude_list = sorted(script_globals.char_dir_nude.glob("*"))
-    if char_count == len(list(char_dir_nude_list)):
+    char_dir_nude_list = script_globals.catalog.char_values()
+    if char_count == len(char_dir_nude_list):
         print("Same number of total files detected!")
         master_list, file_mashup_name = nude_or_clothed(char_dir_nude_list, char_count)
     else:
@@ -411,15 +1652,10 @@ def nude_or_clothed(char_dir_nude_list, char_count):
             if checkall in ["n", "c"]:
                 if checkall == "n":
                     for i in char_dir_nude_list:
-                        char_full_path = i
-                        master_list.append(
-                            Image.open(
-                                char_full_path / next(char_full_path.glob("*.png"))
-                            )
-                        )
+                        master_list.append(script_globals.catalog.sprites(i, True)[0])
                         file_mashup_name += (
                             f"{'&' if file_mashup_name else ''}"
-                            f"({'_'.join([str(csl.char_entry_value_strip(i.name)), 'N'])})"
+                            f"({'_'.join([str(i), 'N'])})"
                         )
                 elif checkall == "c":
                     merge_images_clothed()
@@ -440,7 +1676,7 @@ def request_images_manual(char_count):
     """
     Manual selection of images to merge together.
     :param char_count: Number of chars to merge together.
-    :return: master_list: List of images to grab,
+    :return: master_list: List of sprite paths to grab,
     file_mashup_name: Name of file to save merged as.
     """
     file_mashup_name = ""
@@ -466,23 +1702,28 @@ def request_images_manual(char_count):
             clothes = input("Should they wear clothes? Y/N: ").lower()[:1]
             if clothes in ["y", "n"]:
                 if clothes == "y":
-                    char_content = script_globals.char_dir_clothed / char_val
-                    char_content_data = sorted(char_content.glob("*.png"))
-                    file_name, file_path, re_status = image_validation(
-                        char_content_data, csl.char_entry_value_strip(char_val)
+                    char_content_data = script_globals.catalog.sprites(
+                        csl.char_entry_value_strip(char_val), False
                     )
+                    file_name, file_path, re_status = "", "", False
+                    if char_content_data:
+                        file_name, file_path, re_status = image_validation(
+                            char_content_data, csl.char_entry_value_strip(char_val)
+                        )
                     if re_status:
                         file_mashup_name += (
                             f"{'&' if file_mashup_name else ''}"
                             f"({'_'.join([str(file_name), 'C'])})"
                         )
-                        master_list.append(Image.open(file_path))
+                        master_list.append(file_path)
                     else:
                         char_count += 1
                         logging.warning("File not found. Returning an entry to loop.")
                 else:
-                    char_content = script_globals.char_dir_nude / str(char_val)
-                    master_list.append(Image.open(next(char_content.glob("*.png"))))
+                    char_content = script_globals.catalog.sprites(
+                        csl.char_entry_value_strip(char_val), True
+                    )
+                    master_list.append(char_content[0])
                     file_mashup_name += (
                         f"{'&' if file_mashup_name else ''}"
                         f"({'_'.join([str(char_val), 'N'])})"
@@ -509,12 +1750,12 @@ def request_images_automatic(spt_args):
         elif item == "-c":
             current_flag = "c"
         elif item == "-an":
-            dir_list = sorted(script_globals.char_dir_nude.glob("*"))
-            n_integers = [i.glob("*") for i in dir_list]
+            n_integers = script_globals.catalog.char_values("nude")
+            n_filename = "(all_n)"
             break
         elif item == "-ac":
-            dir_list = sorted(script_globals.char_dir_clothed.glob("*"))
-            c_integers = [i.glob("*") for i in dir_list]
+            c_integers = script_globals.catalog.char_values("clothed")
+            c_filename = "(all_c)"
             break
         else:
             if current_flag == "n":
@@ -531,26 +1772,30 @@ def request_images_automatic(spt_args):
                     f"{'&' if c_filename else ''}"
                     f"({'_'.join([str(item), current_flag])})"
                 )
-    n_result = request_images_automatic_extract(n_integers, True)
-    c_result = request_images_automatic_extract(c_integers, False)
+    with tracer.span("request"):
+        n_result = request_images_automatic_extract(n_integers, True)
+        c_result = request_images_automatic_extract(c_integers, False)
+    # Both lineups are encoded together.
+    outputs = []
     if n_result:
-        merge_images(n_result, n_filename, 0)
+        outputs += prepare_lineup(n_result, n_filename, 0)
     if c_result:
-        merge_images(c_result, c_filename, 1)
+        outputs += prepare_lineup(c_result, c_filename, 1)
+    encode_outputs(outputs)
+    print_saved(outputs)
 
 
 def request_images_automatic_extract(img_list, nude):
     result = []
-    if nude:
-        char_path = script_globals.char_dir_nude
-    else:
-        char_path = script_globals.char_dir_clothed
     for i in img_list:
-        clothed_dir = char_path / csl.listdir_int_match(char_path, i)
-        clothed_check = sorted(clothed_dir.glob("*"))
-        file_name, file_path, re_status = image_validation(clothed_check, i)
+        clothed_check = script_globals.catalog.sprites(i, nude)
+        if not clothed_check:
+            logging.warning("Character entry no.%s is not in the catalog.", i)
+            re_status = False
+        else:
+            file_name, file_path, re_status = image_validation(clothed_check, i)
         if re_status:
-            result.append(Image.open(clothed_dir / file_path))
+            result.append(file_path)
         else:
             logging.warning("Error. File not found. Aborting.")
             sys.exit()
@@ -569,162 +1814,1722 @@ def request_images_singular_char():
     return main_char, "test", 0
 
 
+def run_jobs_file(jobs_file):
+    """
+    Batch mode (--jobs-file). Runs every job in the file in one go, with no prompts, sharing the catalog and sprite
+    cache between them. A job that can't be run is logged and skipped, the rest still go ahead.
+    Each job is a dict:
+        "characters": List of character numbers. Required.
+        "clothed": Bool, default false.
+        "variant": Clothed variant, either an index (default 0, the first) or part of the file name.
+        "row_width": Sprites per row, default 10.
+        "quality": 0 for lossless (default), 1 for lossy.
+        "name": Output file name, no folders. Defaults to the usual '(1,5,9_n)' style.
+    :param jobs_file: Path to a json (or yaml, if PyYAML is installed) file. Either a list of jobs, or a dict with
+    them under "jobs".
+    :return: List of the job numbers (from 1) that were skipped, or had any file fail to save. Exits if the file
+    itself can't be read.
+    """
+    jobs_file = Path(jobs_file)
+    yaml = None
+    if jobs_file.suffix.lower() in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            logging.error("Reading %s needs PyYAML. pip install pyyaml, or use json.", jobs_file.name)
+            sys.exit(1)
+    # ValueError covers bad json, and text that isn't utf-8.
+    read_errors = (OSError, ValueError) + ((yaml.YAMLError,) if yaml else ())
+    try:
+        with open(jobs_file, "r", encoding="utf-8") as jobs_data:
+            jobs = yaml.safe_load(jobs_data) if yaml else json.load(jobs_data)
+    except read_errors as f:
+        logging.error("Couldn't read jobs file %s: %s", jobs_file, f)
+        sys.exit(1)
+    if isinstance(jobs, dict):
+        jobs = jobs.get("jobs", [])
+    if not isinstance(jobs, list):
+        logging.error("%s should hold a list of jobs.", jobs_file)
+        sys.exit(1)
+
+    outputs = []
+    failed = []
+    for job_no, job in enumerate(jobs, 1):
+        try:
+            clothed = bool(job.get("clothed", False))
+            characters = [int(char_val) for char_val in job["characters"]]
+            images = [job_sprite(char_val, clothed, job.get("variant", 0)) for char_val in characters]
+            filename = job.get("name") or f"({','.join(map(str, characters))}_{'c' if clothed else 'n'})"
+            if not isinstance(filename, str) or filename in (".", "..") or any(sep in filename for sep in "/\\"):
+                raise ValueError(f"name {filename!r} should be a plain file name, saved in Output.")
+            quality = int(job.get("quality", 0))
+            if quality not in [0, 1]:
+                raise ValueError("quality should be 0 (lossless) or 1 (lossy).")
+            job_outputs = prepare_lineup(
+                images, filename, int(clothed), file_quality=quality, row_max=int(job.get("row_width", 10))
+            )
+        except (KeyError, ValueError, TypeError, AttributeError) as f:
+            logging.error("Job %s skipped: %s", job_no, f)
+            failed.append(job_no)
+            continue
+        for output in job_outputs:
+            output["job"] = job_no
+        outputs += job_outputs
+    encode_outputs(outputs)
+    print_saved(outputs)
+    for output in outputs:
+        if output["failed"] and output["job"] not in failed:
+            failed.append(output["job"])
+    if failed:
+        failed.sort()
+        logging.error("%s of %s jobs failed: %s", len(failed), len(jobs), ", ".join(map(str, failed)))
+    return failed
+
+
+def job_sprite(char_val, clothed, variant=0):
+    """
+    Prompt-free stand-in for image_validation.
+    :param char_val: Int, character entry number.
+    :param clothed: Bool.
+    :param variant: Index into the character's clothed variants, or part of the variant's file name.
+    :return: Sprite path.
+    """
+    sprites = script_globals.catalog.sprites(char_val, not clothed)
+    if not sprites:
+        raise ValueError(f"Character entry no.{char_val} not found.")
+    if not clothed:
+        return sprites[0]
+    if isinstance(variant, str):
+        matches = [sprite for sprite in sprites if variant in sprite.stem]
+        if not matches:
+            raise ValueError(f"Character entry no.{char_val} has no variant matching '{variant}'.")
+        return matches[0]
+    if not 0 <= variant < len(sprites):
+        raise ValueError(f"Character entry no.{char_val} only has {len(sprites)} variants.")
+    return sprites[variant]
+
+
 # Step 4
+class SpriteCache:
+    """
+    Size-bounded LRU of decoded sprites, shared by every lineup in the session, so a character used in both the
+    nude and clothed lineups (or in job after job) is only decoded once. Keyed by path and mtime, so a sprite that
+    gets re-cut is never served stale.
+    """
+
+    def __init__(self, max_mb):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.sprites = collections.OrderedDict()
+        self.held_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, sprite_path):
+        """
+        :param sprite_path: Path to the sprite png.
+        :return: Decoded RGB(A) numpy array. Read only, as it's shared.
+        """
+        key = (str(sprite_path), os.stat(sprite_path).st_mtime_ns)
+        with self.lock:
+            if key in self.sprites:
+                self.sprites.move_to_end(key)
+                self.hits += 1
+                return self.sprites[key]
+            self.misses += 1
+        decoded = decode_sprite(sprite_path)
+        if decoded.nbytes > self.max_bytes:
+            return decoded
+        with self.lock:
+            if key not in self.sprites:
+                self.sprites[key] = decoded
+                self.held_bytes += decoded.nbytes
+                while self.held_bytes > self.max_bytes:
+                    _, evicted = self.sprites.popitem(last=False)
+                    self.held_bytes -= evicted.nbytes
+        return decoded
+
+    def log_stats(self):
+        logging.info(
+            "Sprite cache: %s hits, %s misses, %.0f MB held.",
+            self.hits,
+            self.misses,
+            self.held_bytes / (1024 * 1024),
+        )
+
+
+class RenderCache:
+    """
+    Finished lineups, filed under a hash of everything that went into them (see lineup_key). Asking for the same
+    lineup again just copies the stored file out, instead of compositing and encoding it all over again.
+    Files are evicted least recently used first once the cache is over max_mb, or once unused for max_days.
+    """
+
+    def __init__(self, cache_dir, max_mb, max_days):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_age = max_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+
+    def cache_path(self, key, file_format):
+        return self.cache_dir / f"{key}.{file_format}"
+
+    def fetch(self, key, file_format, file_path):
+        """
+        :param key: From lineup_key. None never hits.
+        :param file_format: "webp", "png"...
+        :param file_path: Where to copy the cached lineup to, on a hit.
+        :return: True on a hit.
+        """
+        if key is None or self.max_bytes <= 0:
+            return False
+        cache_path = self.cache_path(key, file_format)
+        try:
+            os.utime(cache_path)  # mtime doubles as last used, for eviction.
+            shutil.copyfile(cache_path, file_path)
+        except OSError:
+            return False
+        return True
+
+    def read(self, key, file_format):
+        """
+        :return: The cached lineup as bytes, or None on a miss.
+        """
+        if key is None or self.max_bytes <= 0:
+            return None
+        cache_path = self.cache_path(key, file_format)
+        try:
+            os.utime(cache_path)
+            with open(cache_path, "rb") as cached:
+                return cached.read()
+        except OSError:
+            return None
+
+    def store(self, key, file_format, file_path=None, data=None):
+        """
+        Keeps a copy of a freshly encoded lineup. Copied rather than hard linked, so nothing done to the file in
+        Output can reach the cache.
+        :param key: From lineup_key. None stores nothing.
+        :param file_format: "webp", "png"...
+        :param file_path: Encoded file to copy in.
+        :param data: Or, the encoded bytes.
+        :return: None
+        """
+        if key is None or self.max_bytes <= 0:
+            return
+        cache_path = self.cache_path(key, file_format)
+        temp_path = cache_path.with_name(f"{cache_path.name}.{threading.get_ident()}.tmp")
+        try:
+            if data is None:
+                shutil.copyfile(file_path, temp_path)
+            else:
+                with open(temp_path, "wb") as cached:
+                    cached.write(data)
+            os.replace(temp_path, cache_path)
+        except OSError as f:
+            logging.warning("Couldn't store %s in the render cache: %s", cache_path.name, f)
+            return
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            cached_files = []
+            for dir_entry in os.scandir(self.cache_dir):
+                if dir_entry.is_file() and not dir_entry.name.endswith(".tmp"):
+                    stat = dir_entry.stat()
+                    cached_files.append((stat.st_mtime, stat.st_size, dir_entry.path))
+            held_bytes = sum(size for _, size, _ in cached_files)
+            cutoff = time.time() - self.max_age
+            for last_used, size, cached_file in sorted(cached_files):
+                if last_used >= cutoff and held_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(cached_file)
+                except OSError:
+                    continue
+                held_bytes -= size
+
+
+class RowCache(RenderCache):
+    """
+    --incremental. Composited rows, kept full size (before any scaling to fit) as .npy, filed under band_key.
+    A lineup that only differs from an earlier one in a row or two only has to decode and paste those rows. The
+    rest are read back, and just scaled again, so they're reused even when the lineup grows a row and the scale
+    changes. Evicted the same way as RenderCache.
+    """
+
+    def load_band(self, key, target):
+        """
+        :param key: From band_key. None never hits.
+        :param target: Array to read the row into. Has to be the same shape as the stored one.
+        :return: True on a hit.
+        """
+        if key is None or self.max_bytes <= 0:
+            return False
+        cache_path = self.cache_path(key, "npy")
+        try:
+            band = np.load(cache_path, mmap_mode="r")
+            if band.shape != target.shape:
+                return False
+            target[:] = band
+            os.utime(cache_path)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def store_band(self, key, band):
+        if key is None or self.max_bytes <= 0:
+            return
+        cache_path = self.cache_path(key, "npy")
+        temp_path = cache_path.with_name(f"{cache_path.name}.{threading.get_ident()}.tmp")
+        try:
+            with open(temp_path, "wb") as cached:
+                np.save(cached, band)
+            os.replace(temp_path, cache_path)
+        except OSError as f:
+            logging.warning("Couldn't store %s in the row cache: %s", cache_path.name, f)
+            return
+        self.evict()
+
+
+def sprite_fingerprints(rows):
+    """
+    :param rows: List of lists of sprite paths.
+    :return: Path and mtime of every sprite, row by row. None if any sprite isn't a file (an open Image).
+    Size is left out, as recompress_sprites shrinks sprites without changing them (it keeps the mtime).
+    """
+    fingerprints = []
+    for row in rows:
+        row_fingerprints = []
+        for sprite in row:
+            if not isinstance(sprite, (str, Path)):
+                return None
+            row_fingerprints.append([str(sprite), os.stat(sprite).st_mtime_ns])
+        fingerprints.append(row_fingerprints)
+    return fingerprints
+
+
+def lineup_key(rows, maxsize, file_quality):
+    """
+    Content address of a lineup. Sprites are fingerprinted in order (see sprite_fingerprints), so a re-cut sprite
+    gives a new key.
+    :param rows: List of lists of sprite paths, as laid out.
+    :param maxsize: (width, height) the lineup is fitted into.
+    :param file_quality: 0 for lossless, 1 for lossy.
+    :return: Hex string, or None if any sprite isn't a file.
+    """
+    fingerprints = sprite_fingerprints(rows)
+    if fingerprints is None:
+        return None
+    layout = [2, fingerprints, list(maxsize), file_quality]
+    if script_globals.trim:
+        layout += ["trim", script_globals.trim_padding]
+    if script_globals.preview:
+        layout += ["preview", script_globals.preview]
+    layout = json.dumps(layout, separators=(",", ":"))
+    return hashlib.blake2b(layout.encode(), digest_size=16).hexdigest()
+
+
+def band_key(sprites, merged_width, cells=None):
+    """
+    Content address of one full size row, for RowCache.
+    :param sprites: List of sprite paths in the row.
+    :param merged_width: Int, width of the row including padding.
+    :param cells: The row's cells from lineup_layout, if trimmed.
+    :return: Hex string, or None if any sprite isn't a file.
+    """
+    fingerprints = sprite_fingerprints([sprites])
+    if fingerprints is None:
+        return None
+    layout = [1, fingerprints, merged_width]
+    if cells is not None:
+        layout.append(cells)
+    layout = json.dumps(layout, separators=(",", ":"))
+    return hashlib.blake2b(layout.encode(), digest_size=16).hexdigest()
+
+
+class SpriteStore:
+    """
+    --sprite-store. Decoded sprites kept raw, one fixed size record each (1600 x 1200 x RGB) in a single file, with
+    a json index of which record holds which sprite. The compositor reads records straight out of a memory map, so
+    once a sprite is in, it's never PNG decoded again, or even copied.
+    Filled as sprites are cut (process_image_2), and the first time any other sprite is composited. Re-cut sprites
+    get a new record, so records still being read are never written over. The old ones are left behind until the
+    store is rebuilt (python mainv2.py rebuild-sprite-store).
+    """
+
+    version = 1
+    record_shape = (1600, 1200, 3)
+    record_bytes = 1600 * 1200 * 3
+
+    def __init__(self, store_file, index_file):
+        self.store_file = Path(store_file)
+        self.index_file = Path(index_file)
+        self.records = {}  # Sprite, relative to Character_Lists -> [record no., png mtime, png size]
+        self.slots = 0
+        self.mapped = None
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as index_json:
+                data = json.load(index_json)
+            store_size = self.store_file.stat().st_size
+        except (OSError, ValueError):
+            data = {}
+            store_size = 0
+        if data.get("version") == self.version and data.get("record_shape") == list(self.record_shape):
+            self.slots = min(data["slots"], store_size // self.record_bytes)
+            self.records = {key: record for key, record in data["records"].items() if record[0] < self.slots}
+
+    def save(self):
+        """
+        Writes the index, if anything was added. Records are always written before the index points at them.
+        :return: None
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            temp_file = self.index_file.with_suffix(".tmp")
+            with open(temp_file, "w", encoding="utf-8") as index_json:
+                json.dump(
+                    {
+                        "version": self.version,
+                        "record_shape": list(self.record_shape),
+                        "slots": self.slots,
+                        "records": self.records,
+                    },
+                    index_json,
+                    separators=(",", ":"),
+                )
+            os.replace(temp_file, self.index_file)
+            self.dirty = False
+        if self.slots > 2 * len(self.records) + 100:
+            logging.info(
+                "Sprite store is mostly old records. python mainv2.py rebuild-sprite-store would shrink it."
+            )
+
+    @staticmethod
+    def sprite_key(sprite_path):
+        try:
+            return Path(sprite_path).relative_to(script_globals.char_dir).as_posix()
+        except ValueError:
+            return str(sprite_path)
+
+    def get(self, sprite_path):
+        """
+        :param sprite_path: Path to the sprite png.
+        :return: RGB view into the store, read only. None if the sprite isn't in, or the png changed since.
+        """
+        stat = os.stat(sprite_path)
+        with self.lock:
+            record = self.records.get(self.sprite_key(sprite_path))
+            if not record or record[1] != stat.st_mtime_ns or record[2] != stat.st_size:
+                return None
+            if self.mapped is None or len(self.mapped) <= record[0]:
+                # Records were added since it was last mapped.
+                self.mapped = np.memmap(self.store_file, dtype=np.uint8, mode="r").reshape(-1, *self.record_shape)
+            return self.mapped[record[0]]
+
+    def restat(self, sprite_path, old_stat):
+        """
+        For a png that was rewritten with the same pixels (see recompress_sprites). Keeps its record current.
+        :param sprite_path: Path to the sprite png.
+        :param old_stat: os.stat_result of the png before it was rewritten.
+        :return: None
+        """
+        stat = os.stat(sprite_path)
+        with self.lock:
+            record = self.records.get(self.sprite_key(sprite_path))
+            if record and record[1] == old_stat.st_mtime_ns and record[2] == old_stat.st_size:
+                record[1:] = [stat.st_mtime_ns, stat.st_size]
+                self.dirty = True
+
+    def put(self, sprite_path, pixels):
+        """
+        Adds a sprite. Anything not panel sized is left out, and just keeps being read from its png.
+        :param sprite_path: Path to the sprite png, already saved.
+        :param pixels: Decoded RGB(A) numpy array.
+        :return: None
+        """
+        if pixels.shape[:2] != self.record_shape[:2]:
+            return
+        stat = os.stat(sprite_path)
+        record = np.ascontiguousarray(pixels[..., :3])
+        with self.lock:
+            with open(self.store_file, "r+b" if self.store_file.exists() else "wb") as store:
+                store.seek(self.slots * self.record_bytes)
+                store.write(record.data)
+            self.records[self.sprite_key(sprite_path)] = [self.slots, stat.st_mtime_ns, stat.st_size]
+            self.slots += 1
+            self.dirty = True
+
+
+def rebuild_sprite_store():
+    """
+    python mainv2.py rebuild-sprite-store. Builds the sprite store over from every sprite png in the catalog, into
+    a new file, which then replaces the old one. Drops the records of re-cut and removed sprites along the way.
+    :return: None
+    """
+    catalog = script_globals.catalog
+    sprites = []
+    for key in sorted(catalog.chars, key=int):
+        sprites += catalog.sprites(int(key), True) + catalog.sprites(int(key), False)
+
+    start = time.perf_counter()
+    store = SpriteStore(
+        script_globals.sprite_store_file.with_suffix(".rebuild"),
+        script_globals.sprite_store_index.with_suffix(".rebuild"),
+    )
+    store.records = {}
+    store.slots = 0
+    if store.store_file.exists():
+        store.store_file.unlink()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        for sprite_path, pixels in zip(sprites, executor.map(decode_sprite, sprites)):
+            store.put(sprite_path, pixels)
+    store.dirty = True
+    store.save()
+    if store.store_file.exists():
+        os.replace(store.store_file, script_globals.sprite_store_file)
+    os.replace(store.index_file, script_globals.sprite_store_index)
+    script_globals.sprite_store = SpriteStore(script_globals.sprite_store_file, script_globals.sprite_store_index)
+    logging.info(
+        "Sprite store rebuilt in %.2fs: %s sprites, %.0f MB.",
+        time.perf_counter() - start,
+        len(store.records),
+        store.slots * store.record_bytes / (1024 * 1024),
+    )
+
+
+def decode_sprite(sprite_path):
+    """
+    :param sprite_path: Path to the sprite png.
+    :return: RGB or RGBA numpy array.
+    """
+    tracer.count("images_decoded")
+    tracer.count("bytes_read", os.stat(sprite_path).st_size)
+    with Image.open(sprite_path) as sprite_image:
+        sprite_image.load()
+        if sprite_image.mode not in ("RGB", "RGBA"):
+            sprite_image = sprite_image.convert("RGB")
+        return csl.img_to_numpy(sprite_image)
+
+
+def sprite_bgr(sprite):
+    """
+    Decodes a sprite for compositing. Read straight from the sprite store if there is one and the sprite's in it,
+    otherwise through the sprite cache if there is one.
+    :param sprite: Path to the sprite png, or an already open Image.
+    :return: BGR numpy array. A channel-swapped view over the decoded pixels, not a copy.
+    """
+    if isinstance(sprite, Image.Image):
+        if sprite.mode not in ("RGB", "RGBA"):
+            sprite = sprite.convert("RGB")
+        return csl.img_to_numpy(sprite)[..., 2::-1]
+
+    sprite_store = script_globals.sprite_store
+    if sprite_store is not None:
+        stored = sprite_store.get(sprite)
+        if stored is not None:
+            return stored[..., 2::-1]
+    if script_globals.sprite_cache is not None:
+        decoded = script_globals.sprite_cache.get(sprite)
+    else:
+        decoded = decode_sprite(sprite)
+    if sprite_store is not None:
+        sprite_store.put(sprite, decoded)
+    return decoded[..., 2::-1]
+
+
+def memory_budget():
+    """
+    :return: --memory-budget in bytes. Half the machine's RAM if not set, or 4 GB where that can't be told.
+    """
+    if script_globals.memory_budget > 0:
+        return script_globals.memory_budget * 1024 * 1024
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+    except (AttributeError, ValueError, OSError):  # No sysconf on Windows.
+        return 4096 * 1024 * 1024
+
+
+def plan_lineup(rows, maxsize=(16000, 16000), file_quality=0, allow_split=True, name=None):
+    """
+    Works out how a lineup is going to be built before anything is allocated for it. From the rows alone it gets
+    the canvas size, whether it has to be scaled down for the encoder (maxsize), and roughly what building and
+    encoding it peaks at: the canvas, the rows of sprites decoded ahead, the band rows are scaled through, the
+    sprite cache and what each --formats encoder allocates on top (see encode_memory). Then it picks the first of
+    these that fits in --memory-budget:
+    in-memory: The canvas is in RAM.
+    streamed: The canvas is a memory-mapped temp file (see lineup_canvas), which the OS can page out.
+    tiled: Too big for the encoder, so each row is built full size in a band and scaled into the canvas from there.
+    The canvas goes in RAM or is streamed, same as above.
+    split: Full size pages (see lineup_pages). With --split when there's too many rows to fit the encoder, or when
+    even a streamed canvas is over budget because of what encoding it takes, in which case pages get fewer rows
+    until they fit (several are encoded at once, so that's counted too).
+    :param rows: List of lists of sprite paths, see lineup_rows.
+    :param maxsize: (width, height) the encoder takes.
+    :param file_quality: 0 for lossless, 1 for lossy. Lossless WebP takes a lot more memory to encode.
+    :param allow_split: False if the lineup has to come out as one image, e.g. for the server.
+    :param name: If given, the plan is logged under this name.
+    :return: Dict with "mode", "width", "height" and "scale" of the canvas, "in_memory" (False if streamed),
+    "page_rows" (split only) and "peak" (estimated bytes).
+    """
+    base_width = 1200  # Don't modify
+    base_height = 1600  # Don't modify
+    factor = script_globals.preview or 1
+    sprite_bytes = base_width * base_height * 4 // factor ** 2  # Decoded RGBA, the worst case.
+    budget = memory_budget()
+    formats = output_formats()
+    encoder_bytes = sum(encode_memory.get(file_format, (12, 12))[file_quality] for file_format in formats)
+    rows_held = script_globals.decode_ahead + 1 if script_globals.decode_pool is not None else 1
+    sprite_cache_bytes = 0
+    if script_globals.sprite_cache is not None:
+        distinct = len({sprite for row in rows for sprite in row if isinstance(sprite, (str, os.PathLike))})
+        sprite_cache_bytes = min(script_globals.cache_mb * 1024 * 1024, distinct * sprite_bytes)
+
+    def canvas_size(page):
+        layout = lineup_layout(page)
+        merged_width = layout["width"]
+        merged_height = sum(layout["heights"])
+        scale = min(1, maxsize[0] / merged_width, maxsize[1] / merged_height)
+        return merged_width, merged_height, round(merged_width * scale), round(merged_height * scale), scale
+
+    def peak(page, in_memory, at_once=1):
+        merged_width, _, width, height, scale = canvas_size(page)
+        per_canvas = (
+            rows_held * max(len(row) for row in page) * sprite_bytes
+            + (base_height // factor * merged_width * 3 if scale < 1 else 0)
+            + (width * height * 3 if in_memory else 0)
+            + width * height * encoder_bytes
+        )
+        # Python and the imports take about 48 MB, and copies made while decoding and encoding add ~15% on top.
+        # Checked against the peak RSS of 60 sprite lineups.
+        return round((at_once * per_canvas + sprite_cache_bytes) * 1.15) + 48 * 1024 * 1024
+
+    def fitting_rows(heights):
+        # Most rows per page that keeps every page within maxsize. Rows can differ in height with --trim, so each
+        # page is checked, not just the first.
+        for count in range(len(heights), 1, -1):
+            if all(sum(heights[i:i + count]) <= maxsize[1] for i in range(0, len(heights), count)):
+                return count
+        return 1
+
+    merged_width, merged_height, width, height, scale = canvas_size(rows)
+    plan = {"width": width, "height": height, "scale": scale, "page_rows": None}
+    page_rows = fitting_rows(lineup_layout(rows)["heights"])
+    if allow_split and script_globals.split_pages and len(rows) > page_rows:
+        plan["mode"] = "split"
+    elif peak(rows, True) <= budget:
+        plan["mode"] = "tiled" if scale < 1 else "in-memory"
+    elif peak(rows, False) <= budget or not allow_split or len(rows) == 1:
+        plan["mode"] = "tiled" if scale < 1 else "streamed"
+    else:
+        plan["mode"] = "split"
+        page_rows = min(page_rows, len(rows) - 1)
+        while page_rows > 1:
+            if peak(rows[:page_rows], False, encode_workers(len(rows), page_rows, len(formats))) <= budget:
+                break
+            page_rows -= 1
+
+    if plan["mode"] == "split":
+        # Pages are encoded side by side, so each gets its share of the budget.
+        at_once = encode_workers(len(rows), page_rows, len(formats))
+        page = rows[:page_rows]
+        _, _, plan["width"], plan["height"], plan["scale"] = canvas_size(page)
+        plan["page_rows"] = page_rows
+        plan["in_memory"] = peak(page, True, at_once) <= budget
+        plan["peak"] = peak(page, plan["in_memory"], at_once)
+    else:
+        plan["in_memory"] = peak(rows, True) <= budget
+        plan["peak"] = peak(rows, plan["in_memory"])
+
+    if name:
+        logging.info(
+            "Plan for %s: %s sprites in %s rows, %sx%s. %s%s%s, canvas %s. Peak around %s MB of a %s MB budget.",
+            name,
+            sum(len(row) for row in rows),
+            len(rows),
+            merged_width,
+            merged_height,
+            plan["mode"],
+            f" into pages of {plan['page_rows']} rows" if plan["page_rows"] else "",
+            f" at {plan['scale']:.2f}x to {plan['width']}x{plan['height']}" if plan["scale"] < 1 else "",
+            "in RAM" if plan["in_memory"] else "streamed to disk",
+            plan["peak"] // (1024 * 1024),
+            budget // (1024 * 1024),
+        )
+        if plan["peak"] > budget:
+            logging.warning("%s doesn't fit --memory-budget even so. Trying anyway.", name)
+    return plan
+
+
+def encode_workers(row_count, page_rows, format_count):
+    """
+    :return: How many encodes encode_outputs runs at once on a split lineup, one per page and format. Each is
+    counted as holding a page, which is a bit over with several formats.
+    """
+    return min(math.ceil(row_count / page_rows) * format_count, os.cpu_count() or 1)
+
+
+def lineup_canvas(height, width, in_memory=True):
+    """
+    Output buffer for a lineup. Unless plan_lineup says it fits in memory, it's backed by a memory-mapped temp file
+    in Output rather than RAM, so the OS can page it out while it's being filled in.
+    :param height: Int.
+    :param width: Int.
+    :param in_memory: Bool, see plan_lineup.
+    :return: BGR numpy array (or memmap), and the temp file backing it (None if in memory).
+    """
+    if in_memory:
+        return np.zeros((height, width, 3), dtype=np.uint8), None
+    handle, canvas_file = tempfile.mkstemp(suffix=".canvas", dir=script_globals.output_dir)
+    os.close(handle)
+    return np.memmap(canvas_file, dtype=np.uint8, mode="w+", shape=(height, width, 3)), canvas_file
+
+
+def release_canvas(canvas_file):
+    if canvas_file:
+        os.remove(canvas_file)
+
+
+def decode_rows(rows, ahead=None):
+    """
+    Decodes rows of sprites ahead of the compositor. With a decode pool (see folder_setup), every sprite is its own
+    task on it (PNG decoding lets go of the GIL), so even a lineup of a row or two is decoded in parallel. Up to
+    `ahead` rows are decoded while the compositor is still pasting the current one; no more, so memory stays
+    bounded at ahead + 1 rows of sprites.
+    :param rows: List of lists of sprite paths.
+    :param ahead: Int, rows decoded ahead. Defaults to --decode-ahead.
+    :return: Generator of (row number, list of BGR sprites, seconds the compositor waited on it), in row order.
+    """
+    decode_pool = script_globals.decode_pool
+    if decode_pool is None:
+        for row, sprites in enumerate(rows):
+            start = time.perf_counter()
+            yield row, [sprite_bgr(sprite) for sprite in sprites], time.perf_counter() - start
+        return
+
+    ahead = max(1, ahead or script_globals.decode_ahead)
+    in_flight = collections.deque()
+
+    def finished():
+        done_row, futures = in_flight.popleft()
+        start = time.perf_counter()
+        sprites = [future.result() for future in futures]
+        return done_row, sprites, time.perf_counter() - start
+
+    try:
+        for row, sprites in enumerate(rows):
+            in_flight.append((row, [decode_pool.submit(sprite_bgr, sprite) for sprite in sprites]))
+            if len(in_flight) > ahead:
+                yield finished()
+        while in_flight:
+            yield finished()
+    finally:
+        # Compositing stopped early (an error, most likely). Don't leave the rest decoding for nothing.
+        for _, futures in in_flight:
+            for future in futures:
+                future.cancel()
+
+
+def sprite_box(sprite):
+    """
+    Content box of a sprite, see content_boxes. Worked out when the sprite is cut. Sprites cut before boxes were
+    kept get theirs worked out the first time they're needed, and kept in the catalog from then on.
+    :param sprite: Path to the sprite png, or an open Image.
+    :return: [left, top, right, bottom].
+    """
+    if isinstance(sprite, Image.Image):
+        return content_boxes([csl.img_to_numpy(sprite)])[0]
+    catalog = script_globals.catalog
+    try:
+        key = Path(sprite).relative_to(script_globals.char_dir).as_posix()
+    except ValueError:
+        key = None
+    box = catalog.boxes.get(key) if catalog is not None and key else None
+    if box is None:
+        if script_globals.sprite_cache is not None:
+            box = content_boxes([script_globals.sprite_cache.get(sprite)])[0]
+        else:
+            box = content_boxes([decode_sprite(sprite)])[0]
+        if catalog is not None and key:
+            catalog.boxes[key] = box
+            catalog.dirty = True
+    return box
+
+
+def lineup_layout(rows):
+    """
+    Where every sprite goes in a lineup, at full size. Normally each gets a whole 1200x1600 cell.
+    With --trim, each is cropped to its content box (see sprite_box) plus trim_padding, and they're packed side by
+    side. A row keeps one top and bottom for all its sprites (the union of their boxes), so they still stand on
+    the same line and heights can still be compared. Crops that would start inside the entry number's corner are
+    grown to take in all of it. Rows end up different widths; the canvas is as wide as the widest.
+    :param rows: List of lists of sprite paths (or open Images).
+    :return: Dict with "width" (of the widest row), "heights" (one per row), "cells" (per row, a list of (x, box),
+    x being where the sprite goes in the row and box the part of the sprite pasted there) and "trim" (the
+    padding, None if not trimmed). With --preview it's all in preview pixels, see preview_layout.
+    """
+    base_width = 1200  # Don't modify
+    base_height = 1600  # Don't modify
+    if not script_globals.trim:
+        layout = {
+            "width": base_width * max(len(row) for row in rows),
+            "heights": [base_height] * len(rows),
+            "cells": [
+                [(base_width * column, (0, 0, base_width, base_height)) for column in range(len(row))]
+                for row in rows
+            ],
+            "trim": None,
+        }
+        return preview_layout(layout)
+
+    padding = script_globals.trim_padding
+    label_width, label_height = entry_label_box[2], entry_label_box[3]
+    layout = {"width": 0, "heights": [], "cells": [], "trim": padding}
+    for row in rows:
+        boxes = [sprite_box(sprite) for sprite in row]
+        filled = [box for box in boxes if box[2]] or [[0, 0, 0, label_height]]
+        top = max(0, min(box[1] for box in filled) - padding)
+        lefts = [max(0, box[0] - padding) for box in boxes]
+        if top < label_height and min(lefts) < label_width:
+            # Some crops would start inside the entry number's corner, showing part of it where it falls, and
+            # pasting it again would double it up. Those keep the whole corner instead, number and all.
+            top = 0
+            lefts = [0 if left < label_width else left for left in lefts]
+        bottom = min(base_height, max(max(box[3] for box in filled) + padding, top + label_height))
+        cells = []
+        x = 0
+        for left, (_, _, right, _) in zip(lefts, boxes):
+            # At least as wide as the entry number, which paste_entry_label puts back in the corner.
+            right = min(base_width, max(right + padding, left + label_width))
+            cells.append((x, (left, top, right, bottom)))
+            x += right - left
+        layout["cells"].append(cells)
+        layout["heights"].append(bottom - top)
+        layout["width"] = max(layout["width"], x)
+    return preview_layout(layout)
+
+
+def preview_layout(layout):
+    """
+    --preview. The same layout, in preview pixels. Box edges are divided down, rather than widths, so cells still
+    line up with the preview sprites, and x is counted up again from those.
+    :param layout: From lineup_layout, full size.
+    :return: The layout, plus "preview" (the --preview factor, 1 if off).
+    """
+    factor = script_globals.preview or 1
+    layout["preview"] = factor
+    if factor == 1:
+        return layout
+    width = 0
+    for row, cells in enumerate(layout["cells"]):
+        x = 0
+        scaled = []
+        for _, (left, top, right, bottom) in cells:
+            scaled.append((x, (left // factor, top // factor, right // factor, bottom // factor)))
+            x += right // factor - left // factor
+        layout["cells"][row] = scaled
+        layout["heights"][row] = scaled[0][1][3] - scaled[0][1][1]
+        width = max(width, x)
+    layout["width"] = width
+    return layout
+
+
+def paste_entry_label(target, x, box, sprite, factor=1):
+    """
+    --trim. Puts a sprite's entry number back in the top left of its cell, as trimming crops it off. Crops that
+    reach into the number's corner already hold all of it (lineup_layout sees to that), so they're left as is.
+    Otherwise whatever in the corner isn't background is copied over, so the sprite under it isn't covered by
+    background. That's only the number, unless the figure itself strays into the corner.
+    :param target: Row being composited, BGR.
+    :param x: Where the cell starts in the row.
+    :param box: The part of the sprite in the cell, (left, top, right, bottom).
+    :param sprite: The whole sprite, BGR.
+    :param factor: --preview factor the sprite is shrunk by.
+    :return: None
+    """
+    left, top, right, bottom = (edge // factor for edge in entry_label_box)
+    if box[0] <= left and box[1] <= top:
+        return
+    label = sprite[top:bottom, left:right][:target.shape[0], :box[2] - box[0]]
+    label_rgb = label[None, ..., 2::-1]  # bg_colours are RGB.
+    on_label = off_background(label_rgb, label_rgb[:, :1, :1, :], script_globals.bg_tolerance)[0]
+    target[:label.shape[0], x:x + label.shape[1]][on_label] = label[on_label]
+
+
+def compose_rows(rows, maxsize=(16000, 16000), row_labels=None, in_memory=None):
+    """
+    Lays rows of sprites out one under the other, into a BGR canvas the encoder can take as is. Rows don't need to
+    be the same length; the canvas is as wide as the longest.
+    Sprites are pasted straight into the canvas as they're decoded. Only when the result has to be scaled down to
+    fit maxsize does a row go through a separate band buffer first, to be resized on its own.
+    Sprites for the next rows are decoded on the decode pool meanwhile (see decode_rows), and the canvas goes to
+    encode_outputs as soon as the last row is in.
+    :param rows: List of lists of sprite paths (or open Images).
+    :param maxsize: (width, height) the result has to fit in. WebP tops out at 16383.
+    :param row_labels: Names for each row. If given, how long each row took is logged.
+    :param in_memory: Whether the canvas goes in RAM, see plan_lineup. Planned here if not given.
+    :return: BGR canvas, and its temp file (see lineup_canvas).
+    """
+    load_now(np, cv2, Image, csl)
+    if in_memory is None:
+        in_memory = plan_lineup(rows, maxsize, allow_split=False)["in_memory"]
+    layout = lineup_layout(rows)
+    merged_width = layout["width"]
+    merged_height = sum(layout["heights"])
+    scale = min(1, maxsize[0] / merged_width, maxsize[1] / merged_height)
+    out_width = round(merged_width * scale)
+    out_height = round(merged_height * scale)
+
+    with tracer.span("composite", rows=len(rows)):
+        merged_image_cv, canvas_file = compose_rows_into(
+            rows, layout, scale, out_width, out_height, row_labels, in_memory
+        )
+    if script_globals.sprite_cache is not None:
+        script_globals.sprite_cache.log_stats()
+    if script_globals.sprite_store is not None:
+        script_globals.sprite_store.save()
+    return merged_image_cv, canvas_file
+
+
+def compose_rows_into(rows, layout, scale, out_width, out_height, row_labels, in_memory):
+    row_cache = script_globals.row_cache
+    merged_width = layout["width"]
+    if layout["preview"] > 1:
+        # --preview. Same rows, built from the sprites' previews.
+        rows = [[preview_sprite(sprite, layout["preview"]) for sprite in row] for row in rows]
+    merged_image_cv, canvas_file = lineup_canvas(out_height, out_width, in_memory)
+    try:
+        band = np.zeros((max(layout["heights"]), merged_width, 3), dtype=np.uint8) if scale < 1 else None
+        row_tops = [0]
+        for height in layout["heights"]:
+            row_tops.append(row_tops[-1] + height)
+
+        def row_target(row):
+            top = round(row_tops[row] * scale)
+            bottom = round(row_tops[row + 1] * scale)
+            return (merged_image_cv[top:bottom] if band is None else band[:layout["heights"][row]]), top, bottom
+
+        def thumbnail(row, top, bottom):
+            if band is not None:
+                with tracer.span("thumbnail", row=row):
+                    merged_image_cv[top:bottom] = cv2.resize(
+                        band[:layout["heights"][row]], (out_width, bottom - top), interpolation=cv2.INTER_AREA
+                    )
+
+        # --incremental. Rows composited before are read back, and only the rest are decoded.
+        row_keys = [None] * len(rows)
+        to_compose = list(range(len(rows)))
+        if row_cache is not None:
+            to_compose = []
+            for row, sprites in enumerate(rows):
+                row_keys[row] = band_key(sprites, merged_width, layout["cells"][row] if layout["trim"] else None)
+                target, top, bottom = row_target(row)
+                if row_cache.load_band(row_keys[row], target):
+                    thumbnail(row, top, bottom)
+                else:
+                    to_compose.append(row)
+            logging.info("Row cache: %s of %s rows reused.", len(rows) - len(to_compose), len(rows))
+
+        for compose_no, sprites, decode_seconds in decode_rows([rows[row] for row in to_compose]):
+            row = to_compose[compose_no]
+            start = time.perf_counter()
+            target, top, bottom = row_target(row)
+            if band is not None:
+                target[:] = 0
+            for (x, (left, top_edge, right, bottom_edge)), sprite in zip(layout["cells"][row], sprites):
+                piece = sprite[top_edge:bottom_edge, left:right]
+                target[:piece.shape[0], x:x + piece.shape[1]] = piece
+                if layout["trim"]:
+                    paste_entry_label(target, x, (left, top_edge, right, bottom_edge), sprite, layout["preview"])
+            if row_keys[row] is not None:
+                row_cache.store_band(row_keys[row], target)
+            thumbnail(row, top, bottom)
+            if row_labels:
+                logging.info(
+                    "Row %s: waited %.2fs on decoding, composited in %.2fs",
+                    row_labels[row],
+                    decode_seconds,
+                    time.perf_counter() - start,
+                )
+    except BaseException:
+        # Don't leave a half-made canvas file in Output.
+        del merged_image_cv
+        release_canvas(canvas_file)
+        raise
+    return merged_image_cv, canvas_file
+
+
+def compose_lineup(images, row_max=10, maxsize=(16000, 16000), in_memory=None):
+    """
+    Lays sprites out row_max to a row. See compose_rows.
+    :param images: List of sprite paths (or open Images).
+    :param row_max: Sprites per row.
+    :param maxsize: (width, height) the result has to fit in.
+    :param in_memory: See compose_rows.
+    :return: BGR canvas, and its temp file (see lineup_canvas).
+    """
+    return compose_rows(lineup_rows(images, row_max), maxsize=maxsize, in_memory=in_memory)
+
+
+def lineup_rows(images, row_max=10):
+    return [images[i:i + row_max] for i in range(0, len(images), row_max)]
+
+
 def merge_images(images, filename, nude=0):
     """
     Final Step. Combines individual image segments together.
-    :param images: Image list.
+    Built one row of sprites at a time (see compose_lineup), so only a row's worth of decoded sprites is ever held,
+    no matter how many characters are merged.
+    :param images: List of sprite paths (or open Images).
     :param filename: Name of file. Expects '(000_C/N)&...', but if longer than 255, replace with alphanumeric string
     of X len.
     :param nude: Boolean. Checks if nude string required to append.
-    :return: None
+    :return: Path of the saved file, without suffix.
+    """
+    outputs = prepare_lineup(images, filename, nude)
+    encode_outputs(outputs)
+    print_saved(outputs)
+    return outputs[0]["path"]
+
+
+def prepare_lineup(images, filename, nude=0, file_quality=None, row_max=10):
+    """
+    Everything merge_images does short of encoding, so several lineups can be handed to encode_outputs together.
+    Compositing is left for encode_outputs to run in its pool, so lineups are only held while being encoded.
+    :param images: List of sprite paths (or open Images).
+    :param filename: See merge_images.
+    :param nude: See merge_images.
+    :param file_quality: 0 for lossless, 1 for lossy. Asked for if not given.
+    :param row_max: Sprites per row.
+    :return: List of outputs for encode_outputs. One, or one per page with --split.
     """
-    base_width = 1200  # Don't modify
-    base_height = 1600  # Don't modify
-    row_max = 10  # Final image width
-    merged_width = base_width * len(images)
-    merged_height = base_height
-    if merged_width > base_width * row_max:
-        merged_width = base_width * row_max
-        merged_height = merged_height * math.ceil(len(images) / row_max)
-    merged_image = Image.new("RGB", (merged_width, merged_height))
-    width = 0
-    height = 0
-    for im in images:
-        merged_image.paste(im, (width, height))
-        width += base_width
-        if width >= base_width * row_max:
-            width = 0
-            height += base_height
     output_dir = script_globals.output_dir
 
-    while True:
+    while file_quality is None:
         try:
             file_quality = int(input("Lossless(0) or Lossy(1)? :"))
             if file_quality not in [0, 1]:
                 raise ValueError("Invalid integer inputted. Please use 0 or 1.")
-            break
         except ValueError:
+            file_quality = None
             logging.warning("Invalid input. Please enter an integer.")
 
+    ##Used for webp support. Rows are scaled down as they're built, rather than thumbnailing the whole thing after.
+    maxsize = (16000, 16000)
+    rows = lineup_rows(images, row_max)
+    cache_key = lineup_key(rows, maxsize, file_quality)
+
     filename_path = Path(output_dir) / f"{filename}"
     if len(str(filename_path)) > 254:
         logging.info(
-            f"File name {filename_path} is too long. Replacing with a randomly generated string of numbers."
+            f"File name {filename_path} is too long. Replacing with the lineup's hash, so the same lineup always "
+            f"gets the same name."
         )
-        filename_path = Path(output_dir) / str(int(time.time()))
+        filename_path = Path(output_dir) / (cache_key[:16] if cache_key else str(int(time.time())))
         if nude == 0:
             filename_path = Path(str(filename_path) + "_nude")
         elif nude == 1:
             filename_path = Path(str(filename_path) + "_clothed")
         else:
             filename_path = Path(str(filename_path) + "_merged")
+    if script_globals.trim:
+        filename_path = Path(f"{filename_path}_trim")
+    if script_globals.preview:
+        filename_path = Path(f"{filename_path}_preview{script_globals.preview}")
+
+    plan = plan_lineup(rows, maxsize, file_quality, name=filename_path.name)
+    script_globals.catalog.save()  # Keeps any sprite boxes --trim had to work out.
+    if plan["mode"] == "split":
+        return lineup_pages(
+            rows, filename_path, file_quality, page_rows=plan["page_rows"], in_memory=plan["in_memory"]
+        )
+    return [
+        {
+            "path": filename_path,
+            "quality": file_quality,
+            "cache_key": cache_key,
+            "compose": functools.partial(
+                compose_lineup, images, row_max=row_max, maxsize=maxsize, in_memory=plan["in_memory"]
+            ),
+        }
+    ]
 
-    ##Used for webp support
-    maxsize = (16000, 16000)
-    merged_image.thumbnail(maxsize, Image.Resampling.LANCZOS)
 
-    merged_image_cv = np.array(merged_image)
-    merged_image_cv = cv2.cvtColor(merged_image_cv, cv2.COLOR_RGB2BGR)
+def lineup_pages(rows, filename_path, file_quality, page_rows=10, row_labels=None, in_memory=None):
+    """
+    --split variant of the lineup output. Rather than scaling the lineup down to fit WebP, it's cut into pages of
+    page_rows rows each, kept at full resolution. An index json lists the pages in order.
+    Pages are only composited once encode_outputs gets to them, so only as many are held as there are encoders.
+    :param rows: List of lists of sprite paths, see lineup_rows.
+    :param filename_path: Output path, without suffix. Pages are saved as <name>_p01.webp and so on.
+    :param file_quality: 0 for lossless, 1 for lossy.
+    :param page_rows: Rows per page.
+    :param row_labels: See compose_rows.
+    :param in_memory: See compose_rows.
+    :return: List of outputs for encode_outputs, one per page.
+    """
+    pages = [rows[i:i + page_rows] for i in range(0, len(rows), page_rows)]
+    page_paths = [Path(f"{filename_path}_p{page_no:02d}") for page_no in range(1, len(pages) + 1)]
+
+    index_path = Path(f"{filename_path}_index.json")
+    with open(index_path, "w", encoding="utf-8") as index_json:
+        json.dump(
+            {
+                "row_max": max(len(row) for row in rows),
+                "page_rows": page_rows,
+                "pages": [
+                    {
+                        "files": [page_path.with_suffix(f".{file_format}").name for file_format in output_formats()],
+                        "sprites": [Path(sprite).stem for row in page for sprite in row],
+                    }
+                    for page, page_path in zip(pages, page_paths)
+                ],
+            },
+            index_json,
+            indent=2,
+        )
+    print(f"File name {index_path} saved!.")
+
+    # Pages are at most 16000px tall, so compose_rows only ever scales these for very wide rows.
+    return [
+        {
+            "path": page_path,
+            "quality": file_quality,
+            "cache_key": lineup_key(page, (16383, 16383), file_quality),
+            "compose": functools.partial(
+                compose_rows,
+                page,
+                maxsize=(16383, 16383),
+                row_labels=row_labels[page_no * page_rows:] if row_labels else None,
+                in_memory=in_memory,
+            ),
+        }
+        for page_no, (page, page_path) in enumerate(zip(pages, page_paths))
+    ]
 
 
-    if file_quality == 0:
-        # logging.info(f"Hit Lossless @ {time.time()}")
-        #
-        # filename_path_lossless_pil = Path(str(filename_path) + "_pil").with_suffix(".webp")
-        # timeS = time.time()
-        # merged_image.save(filename_path_lossless_pil, lossless=True, quality=100, method=6)
-        # timeE = time.time()
-        # logging.info(f"Total time for pillow: {str(timeE - timeS)}")
-
-        # filename_path_lossless_ocv = Path(str(filename_path) + "_ocv101").with_suffix(".webp")
-        filename_path_lossless_ocv = filename_path.with_suffix(".webp")
-        # timeS = time.time()
-        cv2.imwrite(filename_path_lossless_ocv, merged_image_cv, [cv2.IMWRITE_WEBP_QUALITY, 101])
-        # timeE = time.time()
-        # logging.info(f"Total time for OpenCV: {str(timeE - timeS)}")
-
-        print(f"File name {filename_path_lossless_ocv} saved!.")
-
-    elif file_quality == 1:
-        # logging.info(f"Hit Lossy @ {time.time()}")
-
-        # filename_path_lossy_pil = Path(str(filename_path) + "_pil").with_suffix(".webp")
-        # timeS = time.time()
-        # merged_image.save(filename_path_lossy_pil, quality=100, method=6)
-        # timeE = time.time()
-        # logging.info(f"Total time for pillow: {str(timeE - timeS)}")
-
-        # filename_path_lossy_ocv = Path(str(filename_path) + "_ocv95").with_suffix(".webp")
-        filename_path_lossy_ocv = filename_path.with_suffix(".webp")
-        # timeS = time.time()
-        cv2.imwrite(filename_path_lossy_ocv, merged_image_cv, [cv2.IMWRITE_WEBP_QUALITY, 100]) # 100 is still lossy. 101 is lossless.
-        # timeE = time.time()
-        # logging.info(f"Total time for OpenCV95: {str(timeE - timeS)}")
-
-    # else:
-        # starttime = time.time()
-        # maxsize = (16000, 16000)
-        # merged_image.thumbnail(maxsize, Image.Resampling.LANCZOS)
-        #
-        # filename_path_lossless = filename_path.with_suffix(".webp")
-        # merged_image.save(filename_path_lossless, lossless=True, quality=100, method=6)
-        # print(f"File name {filename_path_lossless} saved!.")
-        #
-        # filename_path_lossy = filename_path.with_suffix(".webp")
-        # merged_image.save(filename_path_lossy, quality=100, method=6)
-        # print(f"File name {filename_path_lossy} saved!.")
-
-        # endtime = time.time() - starttime
-        # logging.info(endtime)
-
-
-    print(f"File name {filename_path} saved!.")
-    return filename_path
+def output_formats():
+    """
+    Formats to encode each output in, from --formats. Anything the local OpenCV can't write is dropped, with a
+    warning.
+    :return: List of file extensions, without the dot.
+    """
+    formats = []
+    for file_format in script_globals.formats.lower().split(","):
+        file_format = file_format.strip(" .")
+        # WebP is always there. Checking would mean loading cv2 even when every lineup comes from the render cache.
+        if file_format not in encode_params or (
+            file_format != "webp" and not cv2.haveImageWriter(f".{file_format}")
+        ):
+            logging.warning("Can't encode %s here. Skipping that format.", file_format)
+        elif file_format not in formats:
+            formats.append(file_format)
+    return formats or ["webp"]
+
+
+# Roughly what each encoder allocates on top of the canvas, in bytes per pixel, lossless/lossy. Measured on an
+# 8000x6000 lineup; JXL is a guess. PNG compresses row by row.
+encode_memory = {
+    "webp": (12, 4),
+    "png": (0, 0),
+    "avif": (12, 12),
+    "jxl": (12, 12),
+}
+
+# Encoder settings per format. Lossless(0) or Lossy(1) picks which set.
+encode_params = {
+    "webp": lambda lossy: [cv2.IMWRITE_WEBP_QUALITY, 100 if lossy else 101],  # 100 is still lossy. 101 is lossless.
+    "png": lambda lossy: [cv2.IMWRITE_PNG_COMPRESSION, 6],
+    "avif": lambda lossy: [cv2.IMWRITE_AVIF_QUALITY, 90 if lossy else 100],
+    "jxl": lambda lossy: [cv2.IMWRITE_JPEGXL_QUALITY, 95 if lossy else 100],
+}
+
+
+def encode_outputs(outputs):
+    """
+    Output stage. Every output gets encoded once per format in --formats, all on one thread pool. cv2.imwrite lets
+    go of the GIL while encoding, so the nude and clothed lineups, --split pages and extra formats all encode side
+    by side rather than one after another.
+    Outputs with a "cache_key" are looked up in the render cache first, and only composited if some format misses.
+    :param outputs: List of dicts, each with "path" (no suffix), "quality" (0 lossless, 1 lossy) and either a ready
+    "canvas" (plus its "canvas_file"), or a "compose" callable that makes them, which is run in the pool.
+    Optionally a "cache_key", see lineup_key.
+    A format that fails is logged and skipped. If compositing fails, none of the output's formats are tried again.
+    Each output ends up with "saved" (the files written) and "failed" (the ones that weren't), see print_saved.
+    :return: List of saved paths, one per output per format, None where it failed.
+    """
+    formats = output_formats()
+    render_cache = script_globals.render_cache
+    for output in outputs:
+        output["lock"] = threading.Lock()
+        output["pending"] = len(formats)
+        output["saved"] = []
+        output["failed"] = []
+
+    def encode(output, file_format):
+        file_path = output["path"].with_suffix(f".{file_format}")
+        try:
+            written = write(output, file_format, file_path)
+        except Exception as error:
+            logging.error("Failed to make %s: %s", file_path.name, error)
+            written = False
+        with output["lock"]:
+            output["saved" if written else "failed"].append(file_path)
+        encoded(output)
+        return file_path if written else None
+
+    def write(output, file_format, file_path):
+        cache_key = output.get("cache_key")
+        if render_cache is not None and render_cache.fetch(cache_key, file_format, file_path):
+            logging.info("%s taken from the render cache", file_path.name)
+            return True
+        with output["lock"]:
+            if "compose_error" in output:
+                # Another format already found this output can't be composited.
+                return False
+            if "canvas" not in output:
+                try:
+                    output["canvas"], output["canvas_file"] = output.pop("compose")()
+                except Exception as error:
+                    output["compose_error"] = error
+                    raise
+        load_now(cv2)
+        start = time.perf_counter()
+        with tracer.span("encode", file=file_path.name):
+            if not cv2.imwrite(file_path, output["canvas"], encode_params[file_format](output["quality"])):
+                logging.error("Failed to save %s.", file_path)
+                return False
+            tracer.count("bytes_written", file_path.stat().st_size)
+            if render_cache is not None:
+                render_cache.store(cache_key, file_format, file_path)
+        logging.info("%s encoded in %.2fs", file_path.name, time.perf_counter() - start)
+        return True
+
+    def encoded(output):
+        with output["lock"]:
+            output["pending"] -= 1
+            if not output["pending"] and "canvas" in output:
+                # Last format for this output (saved or not). Let the canvas go.
+                del output["canvas"]
+                release_canvas(output["canvas_file"])
+
+    tasks = [(output, file_format) for output in outputs for file_format in formats]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(tasks), os.cpu_count() or 1) or 1) as executor:
+        futures = [executor.submit(encode, *task) for task in tasks]
+    return [future.result() for future in futures]
+
+
+def print_saved(outputs):
+    """
+    Lists the files encode_outputs actually wrote.
+    :param outputs: Outputs, after encode_outputs.
+    :return: Bool, True if every format of every output was saved.
+    """
+    for output in outputs:
+        for file_path in output["saved"]:
+            print(f"File name {file_path} saved!.")
+    return not any(output["failed"] for output in outputs)
 
 
 def merge_images_clothed():
     """
-    Merge variant. Chars each have their own row.
+    Merge variant. Chars each have their own row, with all their clothed variants side by side.
+    Sized straight from the catalog, and saved the same way as the regular lineups, so it's planned to fit
+    --memory-budget (see plan_lineup), scaled to fit WebP or split into pages, and encoded in every --formats.
+    Sprites are decoded on the decode pool, and how long each row took is logged.
     :return: None
     """
-    char_dir_clothed = script_globals.char_dir_clothed
+    catalog = script_globals.catalog
     output_dir = script_globals.output_dir
 
-    base_height = len(list(char_dir_clothed.glob("*"))) * 1600
-    base_width = 0
-    for char_folder in char_dir_clothed.iterdir():
-        max_width_base = len(list(char_folder.glob("*")))
-        base_width = max(base_width, max_width_base)-1 # -1 cause of the padding empty-name file
-    base_width *= 1200
-
-    merged_image = Image.new("RGB", (base_width, base_height))
-    x = 0  # height
-    y = 0  # width
-    for char_folder in char_dir_clothed.iterdir():
-        for image_file in char_folder.iterdir():
-            if image_file.suffix == ".png":
-                merging_hold = Image.open(image_file)
-                merged_image.paste(merging_hold, (y, x))
-                y += 1200
-        x += 1600
-        y = 0
-    filename = output_dir / f"{time.time()}_clothed.png"
-    merged_image.save(filename)
-    print(f"File name {filename} saved!.")
+    char_values = catalog.char_values("clothed")
+    char_rows = [catalog.sprites(i, False) for i in char_values]
+    row_labels = [catalog.char_dir_name(i) for i in char_values]
+    if not char_rows:
+        logging.warning("No clothed characters to merge.")
+        sys.exit()
+
+    filename_path = output_dir / f"{int(time.time())}_clothed"
+    if script_globals.trim:
+        filename_path = Path(f"{filename_path}_trim")
+    if script_globals.preview:
+        filename_path = Path(f"{filename_path}_preview{script_globals.preview}")
+    maxsize = (16000, 16000)
+    plan = plan_lineup(char_rows, maxsize, 0, name=filename_path.name)
+    catalog.save()  # Keeps any sprite boxes --trim had to work out.
+    if plan["mode"] == "split":
+        outputs = lineup_pages(
+            char_rows,
+            filename_path,
+            0,
+            page_rows=plan["page_rows"],
+            row_labels=row_labels,
+            in_memory=plan["in_memory"],
+        )
+    else:
+        outputs = [
+            {
+                "path": filename_path,
+                "quality": 0,
+                "cache_key": lineup_key(char_rows, maxsize, 0),
+                "compose": functools.partial(
+                    compose_rows, char_rows, maxsize=maxsize, row_labels=row_labels, in_memory=plan["in_memory"]
+                ),
+            }
+        ]
+    encode_outputs(outputs)
+    print_saved(outputs)
     sys.exit()
 
 
+# Render server
+class LineupServer(http.server.HTTPServer):
+    """
+    HTTPServer that hands each connection to a fixed size thread pool, rather than a new thread per request, so
+    only serve_workers lineups are ever being put together at once.
+    """
+
+    def __init__(self, address, workers):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.catalog_lock = threading.Lock()
+        super().__init__(address, LineupRequestHandler)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+
+class LineupRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /lineup?n=1,5,9&c=12 : Lineup of the nude sprites of n, then the clothed sprites of c, laid out the same as
+    merge_images. Optional: variant (clothed variant index, or part of its file name, default 0), row (sprites per
+    row, default 10), quality (0 lossless, default, or 1 lossy), format (default the first of --formats).
+    GET /characters : Json of the character numbers available, nude and clothed.
+    """
+
+    server_version = "CharLineup/1.0"
+    content_types = {"webp": "image/webp", "png": "image/png", "avif": "image/avif", "jxl": "image/jxl"}
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/lineup":
+            self.lineup(urllib.parse.parse_qs(url.query))
+        elif url.path == "/characters":
+            with self.server.catalog_lock:
+                script_globals.catalog.refresh()
+                characters = {
+                    "nude": script_globals.catalog.char_values("nude"),
+                    "clothed": script_globals.catalog.char_values("clothed"),
+                }
+            self.reply(200, json.dumps(characters).encode(), "application/json")
+        else:
+            self.reply(404, b"Not found. Try /lineup?n=1,5,9&c=12\n")
+
+    def lineup(self, query):
+        def param(name, default=""):
+            return query.get(name, [default])[-1]
+
+        try:
+            nude_chars = [int(char_val) for char_val in param("n").split(",") if char_val.strip()]
+            clothed_chars = [int(char_val) for char_val in param("c").split(",") if char_val.strip()]
+            variant = param("variant", "0")
+            variant = int(variant) if variant.isdigit() else variant
+            row_max = int(param("row", "10"))
+            file_quality = int(param("quality", "0"))
+            file_format = param("format", output_formats()[0])
+            if not nude_chars and not clothed_chars:
+                raise ValueError("Give some characters, e.g. ?n=1,5,9&c=12")
+            if file_quality not in [0, 1] or row_max < 1:
+                raise ValueError("quality should be 0 or 1, and row at least 1.")
+            if file_format not in output_formats():
+                raise ValueError(f"format should be one of {', '.join(output_formats())}.")
+        except ValueError as f:
+            self.reply(400, f"{f}\n".encode())
+            return
+
+        try:
+            # Picks up anything cut since the last request, e.g. by a --watch run alongside.
+            with self.server.catalog_lock:
+                script_globals.catalog.refresh()
+                images = [job_sprite(char_val, False) for char_val in nude_chars] + [
+                    job_sprite(char_val, True, variant) for char_val in clothed_chars
+                ]
+        except ValueError as f:
+            self.reply(404, f"{f}\n".encode())
+            return
+
+        start = time.perf_counter()
+        maxsize = (16000, 16000)
+        cache_key = lineup_key(lineup_rows(images, row_max), maxsize, file_quality)
+        data = script_globals.render_cache.read(cache_key, file_format)
+        if data is not None:
+            logging.info("%s taken from the render cache", self.path)
+            self.reply(200, data, self.content_types[file_format])
+            return
+        with tracer.span("serve_lineup", path=self.path):
+            canvas, canvas_file = compose_lineup(images, row_max=row_max, maxsize=maxsize)
+            try:
+                encoded, data = cv2.imencode(f".{file_format}", canvas, encode_params[file_format](file_quality))
+            finally:
+                del canvas
+                release_canvas(canvas_file)
+        if not encoded:
+            self.reply(500, b"Encoding failed.\n")
+            return
+        script_globals.render_cache.store(cache_key, file_format, data=data)
+        logging.info("%s rendered in %.2fs", self.path, time.perf_counter() - start)
+        self.reply(200, data, self.content_types[file_format])
+
+    def reply(self, status, body, content_type="text/plain; charset=utf-8"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        body = memoryview(body).cast("B")
+        for offset in range(0, len(body), 1024 * 1024):
+            self.wfile.write(body[offset:offset + 1024 * 1024])
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s", self.address_string(), format % args)
+
+
+def serve_lineups():
+    """
+    --serve PORT. Keeps the catalog and sprite cache warm, and renders lineups on request over http, so each one
+    doesn't pay for python starting up, the imports and the folder scan. Runs until interrupted.
+    :return: None
+    """
+    server = LineupServer((script_globals.serve_host, script_globals.serve_port), script_globals.serve_workers)
+    print(
+        f"Serving lineups on http://{script_globals.serve_host}:{server.server_address[1]}/lineup?n=1,5,9&c=12 "
+        f"Ctrl+C to stop."
+    )
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+# Benchmarks
+def peak_rss_mb():
+    """
+    :return: Peak resident memory of this process so far, in MB. None where the resource module is missing
+    (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def compose_lineup_legacy(images, row_max=10, maxsize=(16000, 16000)):
+    """
+    How merge_images used to composite: full PIL canvas, Lanczos thumbnail, then copied to numpy and again to BGR.
+    Only kept around to benchmark compose_lineup against.
+    """
+    base_width = 1200
+    base_height = 1600
+    merged_width = base_width * min(len(images), row_max)
+    merged_height = base_height * math.ceil(len(images) / row_max)
+    merged_image = Image.new("RGB", (merged_width, merged_height))
+    width = 0
+    height = 0
+    for im in images:
+        with Image.open(im) as sprite:
+            merged_image.paste(sprite, (width, height))
+        width += base_width
+        if width >= base_width * row_max:
+            width = 0
+            height += base_height
+    merged_image.thumbnail(maxsize, Image.Resampling.LANCZOS)
+    merged_image_cv = np.array(merged_image)
+    merged_image_cv = cv2.cvtColor(merged_image_cv, cv2.COLOR_RGB2BGR)
+    return merged_image_cv, None
+
+
+def compose_benchmark_run(compositor_name, images, decode_workers=1):
+    script_globals.decode_pool = make_decode_pool(decode_workers)
+    baseline_rss = peak_rss_mb()
+    start = time.perf_counter()
+    canvas, canvas_file = globals()[compositor_name](images)
+    seconds = time.perf_counter() - start
+    if script_globals.decode_pool is not None:
+        script_globals.decode_pool.shutdown()
+    result = {
+        "compositor": compositor_name,
+        "decode_workers": decode_workers,
+        "seconds": round(seconds, 3),
+        "peak_rss_mb": peak_rss_mb(),
+        "baseline_rss_mb": baseline_rss,
+        "shape": list(canvas.shape),
+    }
+    del canvas
+    release_canvas(canvas_file)
+    return result
+
+
+def compose_benchmark(images):
+    """
+    Times compose_lineup against the old compositing path, decoding on the compositor's thread, then again on a
+    decode pool if --decode-workers (or the CPU count) gives more than one. Each runs in a fresh process, so the
+    peak memory of one can't hide the other's.
+    :param images: List of sprite paths.
+    :return: List of result dicts, old path first.
+    """
+    runs = [("compose_lineup_legacy", 1), ("compose_lineup", 1)]
+    decode_workers = script_globals.decode_workers or os.cpu_count() or 1
+    if decode_workers > 1:
+        runs.append(("compose_lineup", decode_workers))
+    results = []
+    for compositor_name, workers in runs:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, initializer=pool_initializer, initargs=(pool_settings(),)
+        ) as executor:
+            result = executor.submit(compose_benchmark_run, compositor_name, images, workers).result()
+        logging.info(
+            "%s (%s decode workers): %ss, peak RSS %s MB",
+            compositor_name,
+            workers,
+            result["seconds"],
+            result["peak_rss_mb"],
+        )
+        results.append(result)
+    return results
+
+
+def startup_benchmark(bench_dir):
+    """
+    Times the script started fresh, the way it's normally run: how long until the first prompt shows, and until the
+    lineup is saved. Once building the lineup, once with it already in the render cache, and once more with
+    --no-preprocess on top of that.
+    :param bench_dir: The bench's base dir, with Originals and Character_Lists already set up.
+    :return: Dict of run -> seconds.
+    """
+    script = Path(bench_dir) / Path(__file__).name
+    shutil.copyfile(__file__, script)
+    char_values = ",".join(map(str, script_globals.catalog.char_values()[:10]))
+    results = {}
+    for run_name, extra_args in (("build", []), ("cached", []), ("cached_no_preprocess", ["--no-preprocess"])):
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, script.name, "--formats", script_globals.formats, *extra_args, "-n", char_values],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=bench_dir,
+        )
+        printed = b""
+        while b"Lossless(0) or Lossy(1)?" not in printed:
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk:
+                break
+            printed += chunk
+        first_prompt = time.perf_counter() - start
+        process.communicate(b"0\n", timeout=600)
+        results[run_name] = {
+            "first_prompt_s": round(first_prompt, 3),
+            "output_s": round(time.perf_counter() - start, 3),
+        }
+    return results
+
+
+def png_level_benchmark(sprites):
+    """
+    What each sprite PNG level costs: time to save, size on disk, and time to decode again.
+    :param sprites: List of sprite paths to try it on.
+    :return: Dict of level -> per sprite figures.
+    """
+    sprite_images = []
+    for sprite in sprites:
+        with Image.open(sprite) as sprite_image:
+            sprite_image.load()
+            sprite_images.append(sprite_image)
+    results = {}
+    for level in sorted({1, 6, 9, script_globals.png_level}):
+        save_seconds = decode_seconds = total_bytes = 0
+        for sprite_image in sprite_images:
+            encoded = io.BytesIO()
+            start = time.perf_counter()
+            sprite_image.save(encoded, "PNG", compress_level=level)
+            save_seconds += time.perf_counter() - start
+            total_bytes += encoded.tell()
+            encoded.seek(0)
+            start = time.perf_counter()
+            with Image.open(encoded) as decoded:
+                decoded.load()
+            decode_seconds += time.perf_counter() - start
+        count = max(len(sprite_images), 1)
+        results[f"level_{level}"] = {
+            "save_ms": round(save_seconds * 1000 / count, 1),
+            "kb": round(total_bytes / 1024 / count, 1),
+            "decode_ms": round(decode_seconds * 1000 / count, 1),
+        }
+    return results
+
+
+def synthetic_sheet(sheet_path, costumes, blanks, seed):
+    """
+    Makes a fake character sheet for bench: a nude panel, `costumes` clothed panels, then `blanks` empty ones.
+    Each populated panel gets a noisy figure and an entry number block, so it costs about what real art does to
+    encode and decode.
+    :param sheet_path: Path to save to.
+    :param costumes: Int.
+    :param blanks: Int.
+    :param seed: Int, so runs are repeatable.
+    :return: None
+    """
+    rng = np.random.default_rng(seed)
+    panels = 1 + costumes + blanks
+    sheet = np.empty((1600, 1200 * panels, 4), dtype=np.uint8)
+    sheet[:] = script_globals.bg_colours[0]
+    for panel in range(1 + costumes):
+        left = panel * 1200
+        figure = rng.integers(0, 24, (1200, 500, 3), dtype=np.uint8) + rng.integers(0, 232, 3, dtype=np.uint8)
+        sheet[300:1500, left + 350:left + 850, :3] = figure
+        sheet[10:90, left + 10:left + 110, :3] = rng.integers(0, 64)
+    Image.fromarray(sheet).save(sheet_path, "PNG")
+
+
+def run_benchmark():
+    """
+    bench entry point. Generates synthetic sheets in a temp dir, runs them through the whole pipeline with no
+    prompts, and prints per-stage timings, throughput and peak RSS as JSON so runs can be compared.
+    :return: Dict of results.
+    """
+    sheets = script_globals.bench_sheets
+    costumes = script_globals.bench_costumes
+    blanks = script_globals.bench_blanks
+    stages = {}
+
+    def timed(stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        stages[stage] = {"seconds": round(time.perf_counter() - start, 3)}
+        return result
+
+    with tempfile.TemporaryDirectory(prefix="bambarison_bench_") as bench_dir:
+        script_globals.set_base_dir(Path(bench_dir))
+        script_globals.original_images_dir.mkdir()
+        sheet_paths = [
+            script_globals.original_images_dir / f"{sheet_no:03d}Bench.png" for sheet_no in range(1, sheets + 1)
+        ]
+        timed(
+            "generate",
+            lambda: [synthetic_sheet(path, costumes, blanks, seed) for seed, path in enumerate(sheet_paths)],
+        )
+        sheet_megapixels = sheets * (1 + costumes + blanks) * 1200 * 1600 / 1e6
+
+        timed("folder_setup", folder_setup)
+        timed("preprocess", preprocess_files)
+        stages["preprocess"]["sheets_per_s"] = round(sheets / stages["preprocess"]["seconds"], 2)
+        stages["preprocess"]["megapixels_per_s"] = round(sheet_megapixels / stages["preprocess"]["seconds"], 1)
+
+        sheet_arrays = []
+        for sheet_path in sheet_paths:
+            with Image.open(sheet_path) as sheet:
+                sheet_arrays.append(csl.img_to_numpy(sheet))
+        timed("blank_detection", lambda: [populated_panels(sheet_array) for sheet_array in sheet_arrays])
+        stages["blank_detection"]["megapixels_per_s"] = round(
+            sheet_megapixels / max(stages["blank_detection"]["seconds"], 1e-6), 1
+        )
+        del sheet_arrays
+
+        images = [script_globals.catalog.sprites(i, True)[0] for i in script_globals.catalog.char_values()]
+        canvas, canvas_file = timed("compose", compose_lineup, images)
+        lineup_megapixels = canvas.shape[0] * canvas.shape[1] / 1e6
+        stages["compose"]["megapixels_per_s"] = round(lineup_megapixels / stages["compose"]["seconds"], 1)
+        timed(
+            "encode",
+            encode_outputs,
+            [
+                {
+                    "path": script_globals.output_dir / "bench",
+                    "quality": 1,
+                    "canvas": canvas,
+                    "canvas_file": canvas_file,
+                }
+            ],
+        )
+        del canvas
+        stages["encode"]["megapixels_per_s"] = round(lineup_megapixels / stages["encode"]["seconds"], 1)
+        stages["compose_vs_legacy"] = compose_benchmark(images)
+        stages["png_levels"] = png_level_benchmark(images[:5])
+        stages["startup"] = startup_benchmark(bench_dir)
+
+    results = {
+        "settings": {
+            "sheets": sheets,
+            "costumes": costumes,
+            "blanks": blanks,
+            "jobs": script_globals.jobs,
+            "formats": script_globals.formats,
+            "png_level": script_globals.png_level,
+        },
+        "stages": stages,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(json.dumps(results, indent=2))
+    if script_globals.bench_out:
+        with open(script_globals.bench_out, "w", encoding="utf-8") as bench_json:
+            json.dump(results, bench_json, indent=2)
+    return results
+
+
 # Main
 def main():
     try:
         args_valid = False
         args_valid_flags = ["-n", "-c", "-m", "-an", "-ac"]
+        sys.argv[:] = option_strip(sys.argv)
+        if script_globals.profile:
+            tracer.start()
+        if sys.argv[1:2] == ["bench"]:
+            run_benchmark()
+            sys.exit()
         # Initial folder prerequisite checks
-        folder_setup()
+        with tracer.span("folder_setup"):
+            folder_setup()
 
         # Reads and processes images. If new originals are found, or new clothing, process and break them down.
-        preprocess_files()
+        if not script_globals.no_preprocess:
+            with tracer.span("preprocess"):
+                preprocess_files()
+
+        if sys.argv[1:2] == ["rebuild-sprite-store"]:
+            rebuild_sprite_store()
+            sys.exit()
+
+        if sys.argv[1:2] == ["recompress-sprites"]:
+            recompress_sprites()
+            sys.exit()
+
+        if script_globals.jobs_file:
+            sys.exit(1 if run_jobs_file(script_globals.jobs_file) else 0)
+
+        if script_globals.serve_port:
+            serve_lineups()
+
+        if script_globals.watch:
+            watch_originals()
 
         # Request user settings
         if len(sys.argv) > 1:
@@ -750,7 +3555,8 @@ def main():
             # menu_selection = begin_interface_opt()
             menu_selection = 1
             if menu_selection == 1:
-                master_list, final_name = request_images()
+                with tracer.span("request"):
+                    master_list, final_name = request_images()
                 merge_images(master_list, final_name, 0)
             # elif menu_selection == 2:
             #     master_list, final_name, nude_status = request_images_singular_char()
@@ -770,6 +3576,9 @@ def main():
     except KeyboardInterrupt:
         logging.warning("\nInterrupt caught. Exiting. Brace, brace, brace!")
         sys.exit()
+    finally:
+        if script_globals.profile:
+            tracer.finish(script_globals.profile)
 
 
 if __name__ == "__main__":